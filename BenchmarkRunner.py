@@ -0,0 +1,271 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import json
+import random
+
+from LLMUtilities import (
+  MessageHistory,
+  get_context_window_policy,
+  ActionParser,
+  warm_up_encodings,
+  get_config_value,
+)
+from Utilities import (
+  safeprint,
+  get_unique_timestamp_str,
+  sanitize_filename,
+  EventLog,
+  truncate_event_log,
+)
+from TrialScheduler import run_trials
+from Checkpoints import (
+  TrialCheckpoint,
+  get_run_id,
+  parse_command_line_args,
+)
+
+
+# Shared driver of the benchmark trials. A benchmark describes its environment with a subclass of BenchmarkTrial: the prompts, which actions are valid, and how an action changes the environment and what rewards it gives. The driver runs the conversation with the LLM, the retries after invalid responses, the logging and the checkpoints, which are the same in all benchmarks.
+# The settings below apply to all benchmarks.
+
+
+gpt_timeout = 60
+max_output_tokens = 100
+temperature = 1  # maximum temperature is 2 - https://platform.openai.com/docs/api-reference/chat/create
+
+simulation_length_steps = 100
+num_trials = 10   # how many simulations to run (how many resets?)
+max_parallel_trials = num_trials   # how many trials to run concurrently. Set to 1 in order to run the trials one after another
+num_candidates = 1   # how many candidate responses to request per call. The first valid one is accepted, so that an invalid response does not need another round trip. Costs additional output tokens
+max_invalid_responses = 10   # how many invalid responses are retried per step. After that the step proceeds without consumption
+lockstep_scheduling = False   # advance all trials one step at a time and dispatch the requests of each step concurrently as one batch. Recommended when running many trials, especially against a local server which batches concurrent requests
+model_names = None   # the trials of all listed models are run together. None means the model configured in config.ini
+background_logging = False   # write the logs in a background thread with group commit, so that the disk I/O does not delay the trials. The logs and checkpoints are then flushed by the writer thread
+log_flush_every_rows = None   # in background mode, flush each log after this many rows. The logs are flushed also at each checkpoint and on close
+log_flush_interval_ms = 1000   # in background mode, flush each log when this many milliseconds have passed since its last flush
+columnar_log = False   # additionally write each log in a typed columnar binary format, which can be loaded with Utilities.read_columnar_log without parsing
+prompt_template_logging = False   # log each prompt as a reference to its template together with the parameter values, instead of the full text. The templates are stored once per log file and the prompts can be rendered again with Utilities.render_logged_text
+
+
+# the log columns which the driver fills in. The benchmarks place their own columns in between
+step_events_columns = {
+
+  "model_name": "Model name",
+
+  "trial_no": "Trial number",
+  "step_no": "Step number",
+
+  "prompt": "Prompt message",
+}
+
+response_events_columns = {
+  "input_tokens": "Input tokens",
+  "cached_input_tokens": "Cached input tokens",
+  "output_tokens": "Output tokens",
+  "output_tokens_per_second": "Output tokens per second",
+  "time_to_first_token": "Time to first token (seconds), in streaming mode",
+  "num_invalid_responses": "Number of invalid responses rejected before the action was accepted",
+  "alternative_responses": "Other candidate responses to the same request, as a JSON list",
+}
+
+
+class BenchmarkTrial(object):
+  """The environment of one trial of a benchmark. The subclasses implement the methods which raise NotImplementedError, and set the system prompt. The random changes of the environment are drawn from self.rng, which the driver stores in the checkpoints."""
+
+  system_prompt = None
+
+  def __init__(self, trial_no):
+    self.trial_no = trial_no
+
+    # NB! seed the random number generator in order to make the benchmark deterministic
+    # TODO: add seed to the log file
+    self.rng = random.Random(trial_no)    # initialise each next trial with a different seed so that the random changes are different for each trial. Each trial has its own generator so that concurrently running trials do not affect each other's random sequences
+
+  def create_action_parser(self):
+    return ActionParser()
+
+  def get_state(self):
+    """Returns the state of the environment as a dict, to be stored in the checkpoint"""
+    raise NotImplementedError()
+
+  def set_state(self, state):
+    """Continues from the state returned by get_state()"""
+    raise NotImplementedError()
+
+  def get_prompt(self, step):
+    raise NotImplementedError()
+
+  def is_valid_action(self, action_values):
+    raise NotImplementedError()
+
+  def get_default_action(self):
+    """The zero action, which is taken when the LLM gives no valid response"""
+    return [0]
+
+  def step(self, step, action_values, response_content):
+    """Performs the action. Returns the benchmark's columns of the event to be logged, or None if the trial ends without completing the step"""
+    raise NotImplementedError()
+
+# / class BenchmarkTrial(object):
+
+
+def run_trial(run_id, benchmark_name, events_columns, trial_class, model_name, trial_no):
+  """Runs one trial. This is a generator which yields the LLM completion requests and receives the responses, so that the trial scheduler decides how the requests are dispatched"""
+
+  checkpoint = TrialCheckpoint(run_id, model_name, trial_no)
+  state = checkpoint.load()
+  if state is not None and state["finished"]:
+    return
+
+  experiment_dir = os.path.normpath("data")
+  if state is None:
+    events_fname = benchmark_name + "_" + sanitize_filename(model_name) + "_" + get_unique_timestamp_str() + ".tsv"
+  else:
+    events_fname = state["events_fname"]
+    truncate_event_log(experiment_dir, events_fname, state["log_offset"])   # drop the rows of the steps after the checkpoint
+  events = EventLog(experiment_dir, events_fname, events_columns, columnar=columnar_log, background=background_logging, flush_every_rows=log_flush_every_rows, flush_interval_ms=log_flush_interval_ms, prompt_templates=prompt_template_logging)
+
+  trial = trial_class(trial_no)
+  context_window_policy = get_context_window_policy(model_name)   # the history token budget and step limit are configured in config.ini
+  messages = MessageHistory(model_name)   # keeps a running token count of the messages
+  checkpoint_every_steps = get_config_value("checkpoint_every_steps")   # the trade-off between the flushing of the logs and the steps repeated on resume is described in config.ini
+  action_parser = trial.create_action_parser()   # in streaming mode the response stream is closed as soon as the action has been received
+  messages.append({"role": "system", "content": trial.system_prompt})
+
+  first_step = 1
+  if state is not None:   # continue from the step after the checkpoint
+    messages = state["messages"]
+    trial.rng.setstate(state["rng_state"])
+    trial.set_state(state["trial_state"])
+    events.log_event(state["event"])   # the event of the checkpointed step may not have reached the log before the interruption
+    first_step = state["step"] + 1
+
+  for step in range(first_step, simulation_length_steps + 1):
+
+    prompt = trial.get_prompt(step)
+    messages.append({"role": "user", "content": prompt})
+
+    num_oldest_observations_dropped = context_window_policy.trim(messages)  # TODO!!! store full message log elsewhere
+
+    if num_oldest_observations_dropped > 0:
+      print(f"Context window limit reached, dropped {num_oldest_observations_dropped} oldest observation-action pairs")
+
+    num_invalid_responses = 0
+    while True:
+      response_content, output_message, usage = yield {
+        "model_name": model_name,
+        "gpt_timeout": gpt_timeout,
+        "messages": messages,
+        "temperature": temperature,
+        "max_output_tokens": max_output_tokens,
+        "sample_index": [trial_no, num_invalid_responses] if temperature else num_invalid_responses,   # NB! each retry needs a different sample index, else the same cached response would be returned again. With a nonzero temperature each trial is an independent sample too. With temperature 0 the identical requests of different trials, such as the first step, share the cached response
+        "action_parser": action_parser,
+        "num_candidates": num_candidates,
+      }
+
+      candidates = usage.get("candidates", [response_content])
+      action_values = None
+      chosen_index = 0   # the returned response is the first candidate
+      for candidate_index, candidate in enumerate(candidates):   # accept the first valid candidate, the others are logged as alternatives
+        candidate_action_values = action_parser.parse(candidate)
+        if candidate_action_values is not None and trial.is_valid_action(candidate_action_values):
+          action_values = candidate_action_values
+          response_content = candidate
+          chosen_index = candidate_index
+          output_message = {"role": "assistant", "content": candidate}
+          break
+
+      if action_values is None:  # LLM responded with an invalid action, ignore and retry
+        num_invalid_responses += 1
+        if num_invalid_responses < max_invalid_responses:
+          print(f"Invalid action {response_content} provided by LLM, retrying...")
+          continue
+
+        print(f"Invalid action {response_content} provided by LLM, giving up after {num_invalid_responses} invalid responses and proceeding with a zero action")
+        action_values = trial.get_default_action()
+        output_message = {"role": "assistant", "content": ", ".join(str(action) for action in action_values)}   # keep the conversation consistent with the action actually taken
+
+      alternative_responses = [candidate for candidate_index, candidate in enumerate(candidates) if candidate_index != chosen_index]   # NB! compared by index, since after a completion cache hit the candidates are not the same objects as response_content
+
+      messages.append(output_message)  # add only valid responses to the message history
+      break
+
+    #/ while True:
+
+    step_event = trial.step(step, action_values, response_content)
+    if step_event is None:
+      break
+
+    event = {
+
+      "model_name": model_name,
+
+      "trial_no": trial_no,
+      "step_no": step,
+
+      "prompt": prompt,
+      "action_explanation": "",   # TODO
+
+      "input_tokens": usage.get("input_tokens"),
+      "cached_input_tokens": usage.get("cached_input_tokens"),
+      "output_tokens": usage.get("output_tokens"),
+      "output_tokens_per_second": usage.get("output_tokens_per_second"),
+      "time_to_first_token": usage.get("time_to_first_token"),
+      "num_invalid_responses": num_invalid_responses,
+      "alternative_responses": json.dumps(alternative_responses) if alternative_responses else "",
+    }
+    event.update(step_event)
+
+    # NB! the checkpoint is saved before the event is logged, together with the log size preceding the event. On resume the log is truncated to that size and the event is logged again, so that the log and the checkpoint always match
+    if checkpoint_every_steps and step % checkpoint_every_steps == 0:
+      checkpoint.save({
+        "finished": False,
+        "step": step,
+        "events_fname": events_fname,
+        "log_offset": events.get_offset(),
+        "event": event,
+        "messages": messages,
+        "rng_state": trial.rng.getstate(),
+        "trial_state": trial.get_state(),
+      }, events)
+
+    events.log_event(event)   # NB! the log is flushed together with the next checkpoint, or on close
+
+  #/ for step in range(first_step, simulation_length_steps + 1):
+
+  events.close()
+  checkpoint.save({ "finished": True })
+
+#/ def run_trial(run_id, benchmark_name, events_columns, trial_class, model_name, trial_no):
+
+
+def run_benchmark(benchmark_name, events_columns, trial_class, model_names, resume=None):
+  """Runs num_trials trials of each model. The benchmark name is the prefix of the run id and of the log file names"""
+
+  run_id = get_run_id(benchmark_name, resume)
+  safeprint("Run id: " + run_id)
+
+  trials = [
+    run_trial(run_id, benchmark_name, events_columns, trial_class, trial_model_name, trial_no)
+    for trial_model_name in model_names
+    for trial_no in range(1, num_trials + 1)
+  ]
+  run_trials(trials, max_parallel_trials, lockstep=lockstep_scheduling)
+
+#/ def run_benchmark(benchmark_name, events_columns, trial_class, model_names, resume=None):
+
+
+def run_benchmark_from_command_line(benchmark):
+  """Calls benchmark(model_names, resume) with the models of the settings above, and with the --resume command line option"""
+
+  args = parse_command_line_args()
+  trial_model_names = model_names if model_names is not None else [get_config_value("model_name")]
+  warm_up_encodings(trial_model_names)
+  benchmark(trial_model_names, resume=args.resume)
+
+#/ def run_benchmark_from_command_line(benchmark):
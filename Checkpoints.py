@@ -0,0 +1,171 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import pickle
+
+from Utilities import (
+  PickleStore,
+  get_unique_timestamp_str,
+  sanitize_filename,
+  data_dir,
+)
+
+
+# Step-level checkpoints of the benchmark trials. After each step a trial saves its full state, so that an interrupted run can be continued with the --resume command line option from the step where it stopped, without repeating the LLM calls of the completed steps.
+# Each run has its own folder under data/checkpoints, with one checkpoint file per trial. The checkpoint files are PickleStore files, so that each save appends the new state instead of rewriting the file.
+
+
+checkpoints_dir = "checkpoints"
+latest_run = "latest"
+
+
+def parse_command_line_args():
+
+  import argparse   # NB! imported only when needed, in order to keep the startup fast
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+    "--resume",
+    nargs="?",
+    const=latest_run,
+    default=None,
+    metavar="RUN_ID",
+    help="continue an interrupted run from its checkpoints. Without RUN_ID the latest run of the benchmark is continued"
+  )
+  return parser.parse_args()
+
+# / def parse_command_line_args():
+
+
+def get_run_ids(benchmark_name):
+  """Returns the ids of the earlier runs of the benchmark, oldest first"""
+
+  run_ids_dir = os.path.join(data_dir, checkpoints_dir)
+  if not os.path.exists(run_ids_dir):
+    return []
+
+  prefix = benchmark_name + "_"
+  return sorted(   # the timestamps in the ids sort chronologically
+    run_id for run_id in os.listdir(run_ids_dir)
+    if run_id.startswith(prefix)
+  )
+
+# / def get_run_ids(benchmark_name):
+
+
+def get_run_id(benchmark_name, resume=None):
+  """Returns the id of a new run, or of the run to be resumed"""
+
+  if resume is None:
+    return benchmark_name + "_" + get_unique_timestamp_str()
+
+  if resume == latest_run:
+    run_ids = get_run_ids(benchmark_name)
+    if not run_ids:
+      raise ValueError("No earlier runs of " + benchmark_name + " found to resume")
+    return run_ids[-1]
+
+  if not os.path.exists(os.path.join(data_dir, checkpoints_dir, resume)):
+    raise ValueError("Run " + resume + " not found")
+
+  return resume
+
+# / def get_run_id(benchmark_name, resume=None):
+
+
+class TrialCheckpoint(object):
+  """Checkpoint file of one trial of a run. The state is a dict which is saved after each step. A save interrupted midway leaves the previous state in effect.
+  The message history in state["messages"] is stored incrementally: each message is appended to the file once, as its own record, and the state refers to the messages of the current history by their sequence numbers. So the cost of a save does not grow with the length of the conversation."""
+
+  def __init__(self, run_id, model_name, trial_no):
+
+    run_dir = os.path.join(data_dir, checkpoints_dir, run_id)
+    if not os.path.exists(run_dir):
+      os.makedirs(run_dir, exist_ok=True)
+
+    self.model_name = model_name
+    self.store = PickleStore(os.path.join(checkpoints_dir, run_id, sanitize_filename(model_name) + "_" + str(trial_no) + ".pkls"))
+    self.message_sequence_nos = {}   # id of a saved message -> its sequence number in the file
+    self.saved_messages = []   # keeps the saved messages alive, so that their ids stay unique
+
+  def load(self):
+    """Returns the saved state, or None if the trial has not completed any steps yet"""
+
+    state = self.store.get("state")
+    if state is None or "message_ranges" not in state:
+      return state
+
+    from LLMUtilities import MessageHistory   # NB! imported only when resuming, in order to keep the startup fast
+
+    self.saved_messages = [
+      self.store.get(("message", sequence_no))
+      for sequence_no in range(state["num_saved_messages"])
+    ]
+    self.message_sequence_nos = {id(message): sequence_no for sequence_no, message in enumerate(self.saved_messages)}
+
+    state = dict(state)
+    state["messages"] = MessageHistory(self.model_name, [
+      self.saved_messages[sequence_no]
+      for first, last in state.pop("message_ranges")
+      for sequence_no in range(first, last)
+    ])
+    del state["num_saved_messages"]
+
+    return state
+
+  # / def load(self):
+
+  def get_message_ranges(self, messages):
+    """Assigns sequence numbers to the messages which have not been saved yet. Returns the new messages and the sequence numbers of the history as a list of [first, last) ranges. Since the context window policy drops only whole runs of the oldest messages, the list stays short"""
+
+    new_messages = []
+    ranges = []
+    for message in messages:
+
+      sequence_no = self.message_sequence_nos.get(id(message))
+      if sequence_no is None:
+        sequence_no = len(self.saved_messages)
+        self.message_sequence_nos[id(message)] = sequence_no
+        self.saved_messages.append(message)
+        new_messages.append((sequence_no, message))
+
+      if ranges and ranges[-1][1] == sequence_no:
+        ranges[-1][1] += 1
+      else:
+        ranges.append([sequence_no, sequence_no + 1])
+
+    return new_messages, ranges
+
+  # / def get_message_ranges(self, messages):
+
+  def save(self, state, events=None):
+    """With events, the state is saved only after the log rows preceding it have been flushed, so that the log always contains the rows up to the checkpoint. For a log in background mode the saving happens later in the writer thread"""
+
+    new_messages = []
+    if "messages" in state:
+      new_messages, message_ranges = self.get_message_ranges(state["messages"])
+      state = dict(state)
+      del state["messages"]
+      state["message_ranges"] = message_ranges
+      state["num_saved_messages"] = len(self.saved_messages)
+
+    # snapshots of the state and of the new messages, since the trial continues to modify them
+    data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    new_messages = [(sequence_no, pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)) for sequence_no, message in new_messages]
+
+    def write():
+      for sequence_no, message_data in new_messages:   # NB! the messages are written before the state which refers to them
+        self.store.put(("message", sequence_no), message_data, pickled=True)
+      self.store.put("state", data, pickled=True)
+
+    if events is None:
+      write()
+    else:
+      events.call_after_flush(write)
+
+  # / def save(self, state, events=None):
+
+# / class TrialCheckpoint(object):
@@ -0,0 +1,164 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import time
+import json
+import hashlib
+import threading
+
+
+class CompletionCache(object):
+  """Persistent content-addressed store of LLM completions.
+
+  Entries are kept in an SQLite database indexed by the hash of the request. The database can be shared by concurrently running threads and processes. When the total size of the stored entries exceeds max_size_bytes, the least recently used entries are evicted.
+  The access times of the cache hits are collected in memory and written in one transaction, so that a lookup does not need a write to the database.
+  """
+
+  eviction_target_ratio = 0.9   # after eviction the cache occupies at most this fraction of max_size_bytes
+  access_flush_every = 100   # write the collected access times after this many cache hits. They are written also before each put and eviction, and on close
+
+  def __init__(self, path, max_size_bytes=1024 * 1024 * 1024):
+
+    self.path = path
+    self.max_size_bytes = max_size_bytes
+    self.lock = threading.Lock()
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+      os.makedirs(dirname, exist_ok=True)
+
+    import sqlite3   # NB! imported only when the cache is used, in order to keep the startup fast
+
+    # autocommit mode, transactions are opened explicitly where needed
+    self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    self.connection.execute("PRAGMA journal_mode=WAL")   # readers do not block the writer and vice versa
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.execute(
+      "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+    )
+    self.connection.execute(
+      "CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)"
+    )
+
+    self.pending_access_times = {}   # access times of the cache hits which are not yet written to the database, by key
+    self.num_pending_hits = 0   # counts also the repeated hits of the same key
+    self.size_bytes = self.get_size_bytes()
+
+  @staticmethod
+  def make_key(model_name, messages, temperature, max_output_tokens, sample_index, options=None):
+    """Computes the hash of the request. Different sample indexes denote independent samples of the same request. Options is a dict of any further request settings which affect the response"""
+
+    request = [model_name, list(messages), temperature, max_output_tokens, sample_index]
+    if options:   # requests without options keep their earlier keys
+      request.append(options)
+    request_text = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(request_text.encode("utf-8")).hexdigest()
+
+  def get(self, key):
+
+    with self.lock:
+      row = self.connection.execute(
+        "SELECT value FROM completions WHERE key = ?", (key,)
+      ).fetchone()
+
+      if row is None:
+        return None
+
+      self.pending_access_times[key] = time.time()
+      self.num_pending_hits += 1
+      if self.num_pending_hits >= self.access_flush_every:
+        self.flush_access_times()
+
+    return json.loads(row[0])
+
+  def put(self, key, value):
+
+    value_text = json.dumps(value, ensure_ascii=False)
+    size = len(key) + len(value_text.encode("utf-8"))
+
+    with self.lock:
+
+      self.connection.execute("BEGIN IMMEDIATE")   # NB! the size of a replaced entry is read in the same transaction, so that concurrent writers cannot change it in between
+      try:
+        self.write_access_times()
+
+        row = self.connection.execute(
+          "SELECT size FROM completions WHERE key = ?", (key,)
+        ).fetchone()
+        prev_size = row[0] if row is not None else 0
+
+        self.connection.execute(
+          "INSERT INTO completions (key, value, size, last_access) VALUES (?, ?, ?, ?) "
+          "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, last_access = excluded.last_access",
+          (key, value_text, size, time.time())
+        )
+        self.connection.execute("COMMIT")
+      except Exception:
+        self.connection.execute("ROLLBACK")
+        raise
+
+      self.size_bytes += size - prev_size
+
+      if self.size_bytes > self.max_size_bytes:
+        self.size_bytes = self.get_size_bytes()   # other processes may have added or evicted entries meanwhile
+        if self.size_bytes > self.max_size_bytes:
+          self.evict(self.size_bytes - int(self.max_size_bytes * self.eviction_target_ratio))
+
+  def write_access_times(self):
+    """Writes the collected access times of the cache hits. Called inside a transaction"""
+
+    if self.pending_access_times:
+      self.connection.executemany(
+        "UPDATE completions SET last_access = ? WHERE key = ?",
+        ((access_time, key) for key, access_time in self.pending_access_times.items())
+      )
+      self.pending_access_times.clear()
+    self.num_pending_hits = 0
+
+  def flush_access_times(self):
+
+    self.connection.execute("BEGIN IMMEDIATE")
+    try:
+      self.write_access_times()
+      self.connection.execute("COMMIT")
+    except Exception:
+      self.connection.execute("ROLLBACK")
+      raise
+
+  def get_size_bytes(self):
+    return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+  def evict(self, num_bytes_to_free):
+    """Removes least recently used entries until at least num_bytes_to_free bytes are freed"""
+
+    freed_bytes = 0
+    keys = []
+    for key, size in self.connection.execute(
+      "SELECT key, size FROM completions ORDER BY last_access"
+    ):
+      if freed_bytes >= num_bytes_to_free:
+        break
+      keys.append(key)
+      freed_bytes += size
+
+    self.connection.execute("BEGIN IMMEDIATE")
+    try:
+      self.connection.executemany("DELETE FROM completions WHERE key = ?", ((key,) for key in keys))
+      self.connection.execute("COMMIT")
+    except Exception:
+      self.connection.execute("ROLLBACK")
+      raise
+
+    self.size_bytes = self.get_size_bytes()
+
+  def close(self):
+    with self.lock:
+      if self.pending_access_times:
+        self.flush_access_times()
+      self.connection.close()
+
+# / class CompletionCache(object):
@@ -0,0 +1,94 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import sys
+import site
+import subprocess
+import argparse
+
+
+# Measures the import time of the modules of this repository, each in a fresh interpreter with python -X importtime, and compares it against the budgets below. Every worker process and every tool pays the import time of the modules it uses, so the heavy dependencies, and the standard library modules needed only by some of the functions, are imported only on first use.
+# NB! The interpreter is started without the site module (python -S), with the site-packages folders added to sys.path directly. Otherwise the .pth files of the environment may preload some standard library modules at startup, and their import time would not be counted, so that the results would depend on the environment.
+
+
+import_time_budgets_ms = {   # cumulative import time, including the imported modules which a bare interpreter has not loaded yet. The budgets leave room for the variation between the runs and the machines
+  "Utilities": 50,
+  "CompletionCache": 50,
+  "Tokenizers": 60,
+  "LLMBackends": 40,
+  "LLMUtilities": 70,
+  "TrialScheduler": 70,
+  "Checkpoints": 70,
+  "BenchmarkRunner": 80,
+  "Homeostasis": 90,
+  "Sustainability": 90,
+  "MultiObjectiveHomeostasisParallel": 90,
+  "Environments": 250,   # uses NumPy
+}
+
+
+def get_site_packages_dirs():
+  dirs = list(site.getsitepackages()) if hasattr(site, "getsitepackages") else []
+  if site.ENABLE_USER_SITE:
+    dirs.append(site.getusersitepackages())
+  return [path for path in dirs if os.path.isdir(path)]
+
+
+def measure_import_time(module_name, repeats=5):
+  """Returns the smallest cumulative import time of the module over the repeats, in milliseconds"""
+
+  repository_dir = os.path.dirname(os.path.abspath(__file__))
+  code = "import sys; sys.path.extend(" + repr(get_site_packages_dirs()) + "); import " + module_name
+
+  times = []
+  for _ in range(repeats):
+
+    result = subprocess.run(
+      [sys.executable, "-S", "-X", "importtime", "-c", code],
+      cwd=repository_dir,   # the modules read config.ini from the current folder
+      capture_output=True,
+      text=True,
+      check=True,
+    )
+
+    for line in result.stderr.splitlines():   # format: "import time: self [us] | cumulative | imported package"
+      fields = line.split("|")
+      if len(fields) == 3 and fields[2].strip() == module_name and fields[2].startswith(" " + module_name):   # the top level import is not indented
+        times.append(int(fields[1]) / 1000)
+
+  #/ for _ in range(repeats):
+
+  return min(times)
+
+# / def measure_import_time(module_name, repeats=5):
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Measures the import times of the modules and compares them against the budgets")
+  parser.add_argument("--repeats", type=int, default=5)
+  args = parser.parse_args()
+
+  over_budget = []
+  for module_name, budget_ms in import_time_budgets_ms.items():
+
+    import_time_ms = measure_import_time(module_name, args.repeats)
+    print(f"{module_name}: {import_time_ms:.1f} ms (budget {budget_ms} ms)" + (" OVER BUDGET" if import_time_ms > budget_ms else ""))
+
+    if import_time_ms > budget_ms:
+      over_budget.append(module_name)
+
+  #/ for module_name, budget_ms in import_time_budgets_ms.items():
+
+  if over_budget:
+    sys.exit(1)
+
+# / def main():
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,708 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import re
+import time
+import json
+import random
+import threading
+
+
+# Async clients are created lazily inside the running event loop. All backends share one HTTP connection pool so that many concurrent requests reuse the same keep-alive connections
+max_async_connections = 100   # TODO: config
+async_http_client = None
+
+
+def get_async_http_client():
+  global async_http_client
+
+  if async_http_client is None:
+    import httpx
+
+    async_http_client = httpx.AsyncClient(
+      limits=httpx.Limits(
+        max_connections=max_async_connections,
+        max_keepalive_connections=max_async_connections,
+      ),
+    )
+
+  return async_http_client
+
+# / def get_async_http_client():
+
+
+async def close_async_clients():
+  """Closes the shared connection pool. Needs to be called before the event loop that used the async clients is closed"""
+  global async_http_client
+
+  for backend in backends.values():
+    backend.async_client = None   # the async SDK clients are bound to the pool, so they are recreated on next use
+
+  if async_http_client is not None:
+    await async_http_client.aclose()
+  async_http_client = None
+
+# / async def close_async_clients():
+
+
+class LLMBackend(object):
+  """Interface of the completion backends.
+  The requests are given as OpenAI chat completion arguments. complete() returns a tuple of (response text, finish reason, usage), where usage is a dict with input_tokens, output_tokens and cached_input_tokens keys, or None when the backend does not report usage.
+  When n > 1, usage also contains candidates: the list of all response texts, the first of which is returned as the response text."""
+
+  cacheable = True   # whether the completions should be stored in the completion cache
+  supports_token_counting = False   # whether count_tokens() queries the provider for exact token counts
+  supports_multiple_candidates = False   # whether the provider returns n candidate responses for one request
+
+  def __init__(self):
+    self.client = None
+    self.async_client = None
+    self.lock = threading.Lock()
+
+  def complete(self, timeout, **kwargs):
+    raise NotImplementedError()
+
+  async def complete_async(self, timeout, **kwargs):
+    import asyncio
+    return await asyncio.to_thread(self.complete, timeout, **kwargs)   # fallback for backends without a native async client
+
+  def complete_stream(self, timeout, is_complete=None, **kwargs):
+    """Streams the response and closes the stream as soon as is_complete(text received so far) returns True. The usage dict additionally contains time_to_first_token, and may lack the token counts when the stream was closed early"""
+    return self.complete(timeout, **dict(kwargs, stream=False))   # fallback for backends without streaming support
+
+  async def complete_stream_async(self, timeout, is_complete=None, **kwargs):
+    return await self.complete_async(timeout, **dict(kwargs, stream=False))
+
+  def complete_candidates(self, timeout, **kwargs):
+    """Emulates the n argument for providers which do not support it, by sending n requests concurrently"""
+
+    from concurrent.futures import ThreadPoolExecutor   # NB! imported only when needed, in order to keep the startup fast
+
+    num_candidates = kwargs["n"]
+    with ThreadPoolExecutor(max_workers=num_candidates, thread_name_prefix="candidate") as executor:
+      results = list(executor.map(
+        lambda _: self.complete(timeout, **dict(kwargs, n=1)),
+        range(num_candidates)
+      ))
+
+    return merge_candidate_results(results)
+
+  async def complete_candidates_async(self, timeout, **kwargs):
+
+    import asyncio
+
+    results = await asyncio.gather(*[
+      self.complete_async(timeout, **dict(kwargs, n=1))
+      for _ in range(kwargs["n"])
+    ])
+
+    return merge_candidate_results(results)
+
+  def count_tokens(self, model_name, messages):
+    raise NotImplementedError()
+
+  async def count_tokens_async(self, model_name, messages):
+    import asyncio
+    return await asyncio.to_thread(self.count_tokens, model_name, messages)
+
+# / class LLMBackend(object):
+
+
+def merge_candidate_results(results):
+  """Combines the results of the separate requests into one result with candidates. The token counts are summed since each request is billed separately"""
+
+  usage = {}
+  if all(result_usage is not None for (_, _, result_usage) in results):
+    for key in ["input_tokens", "output_tokens", "cached_input_tokens"]:
+      usage[key] = sum(result_usage[key] for (_, _, result_usage) in results)
+
+  usage["candidates"] = [response_content for (response_content, _, _) in results]
+
+  (response_content, finish_reason, _) = results[0]
+  return (response_content, finish_reason, usage)
+
+# / def merge_candidate_results(results):
+
+
+class StreamAccumulator(object):
+  """Collects the text of a streamed response. Records the time to first token and detects when enough of the response has arrived so that the stream can be closed"""
+
+  def __init__(self, is_complete=None):
+    self.is_complete = is_complete
+    self.time_start = time.time()
+    self.text_parts = []
+    self.finish_reason = None
+    self.usage = {}
+
+  def add_text(self, text):
+    """Returns True when the stream can be closed"""
+
+    if not text:
+      return False
+
+    if "time_to_first_token" not in self.usage:
+      self.usage["time_to_first_token"] = time.time() - self.time_start
+
+    self.text_parts.append(text)
+
+    if self.is_complete is not None and self.is_complete("".join(self.text_parts)):
+      self.finish_reason = "stop"
+      return True
+
+    return False
+
+  def add_openai_chunk(self, chunk):
+
+    if chunk.usage is not None:   # sent in the last chunk, which is not received when the stream is closed early
+      self.usage.update({
+        "input_tokens": chunk.usage.prompt_tokens,
+        "output_tokens": chunk.usage.completion_tokens,
+        "cached_input_tokens": getattr(getattr(chunk.usage, "prompt_tokens_details", None), "cached_tokens", None) or 0,
+      })
+
+    if not chunk.choices:
+      return False
+
+    choice = chunk.choices[0]
+    if choice.finish_reason is not None:
+      self.finish_reason = choice.finish_reason
+
+    return self.add_text(choice.delta.content)
+
+  def add_claude_event(self, event):
+
+    if event.type == "message_start":   # the input usage arrives before the text
+      usage = event.message.usage
+      cached_input_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+      cache_creation_input_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+      self.usage["input_tokens"] = usage.input_tokens + cached_input_tokens + cache_creation_input_tokens
+      self.usage["cached_input_tokens"] = cached_input_tokens
+
+    elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+      return self.add_text(event.delta.text)
+
+    elif event.type == "content_block_delta" and event.delta.type == "input_json_delta":   # structured output via a tool call
+      return self.add_text(event.delta.partial_json)
+
+    elif event.type == "message_delta":
+      self.finish_reason = event.delta.stop_reason
+      self.usage["output_tokens"] = event.usage.output_tokens
+
+    return False
+
+  def get_result(self):
+    return ("".join(self.text_parts), self.finish_reason, self.usage)
+
+# / class StreamAccumulator(object):
+
+
+def parse_openai_response(openai_response):
+
+  openai_response = json.loads(openai_response.content)   # one pass of the C parser, without building the SDK's response objects
+
+  if openai_response.get("error"):
+    if (
+      openai_response["error"]["code"] == 502
+      or openai_response["error"]["code"] == 503
+    ):  # Bad gateway or Service Unavailable
+      import httpcore
+      raise httpcore.NetworkError(openai_response["error"]["message"])
+    else:
+      raise Exception(
+        str(openai_response["error"]["code"])
+        + " : "
+        + openai_response["error"]["message"]
+      )  # TODO: use a more specific exception type
+
+  # NB! this line may also throw an exception if the OpenAI announces that it is overloaded # TODO: do not retry for all error messages
+  response_content = openai_response["choices"][0]["message"]["content"]
+  finish_reason = openai_response["choices"][0]["finish_reason"]
+
+  usage = openai_response.get("usage")
+  if usage is not None:   # some OpenAI compatible servers do not report usage
+    usage = {
+      "input_tokens": usage.get("prompt_tokens", 0),
+      "output_tokens": usage.get("completion_tokens", 0),
+      "cached_input_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+    }
+
+  if len(openai_response["choices"]) > 1:   # the request had n > 1
+    usage = dict(usage or {})
+    usage["candidates"] = [choice["message"]["content"] for choice in openai_response["choices"]]
+
+  return (response_content, finish_reason, usage)
+
+# / def parse_openai_response(openai_response):
+
+
+class OpenAIBackend(LLMBackend):
+
+  supports_multiple_candidates = True
+
+  def __init__(self, api_key_env_var="OPENAI_API_KEY", base_url=None, model_name_prefix=""):
+    super(OpenAIBackend, self).__init__()
+    self.api_key_env_var = api_key_env_var
+    self.base_url = base_url
+    self.model_name_prefix = model_name_prefix   # stripped from the model name before sending the request
+
+  def get_client(self):
+
+    with self.lock:
+      if self.client is None:
+        from openai import OpenAI
+        self.client = OpenAI(api_key=os.getenv(self.api_key_env_var), base_url=self.base_url)
+        print("Initialized OpenAI client" + (" for " + self.base_url if self.base_url else ""))
+
+    return self.client
+
+  def get_async_client(self):
+
+    if self.async_client is None:
+      from openai import AsyncOpenAI
+      self.async_client = AsyncOpenAI(api_key=os.getenv(self.api_key_env_var), base_url=self.base_url, http_client=get_async_http_client())
+
+    return self.async_client
+
+  def get_request_kwargs(self, kwargs):
+
+    kwargs = dict(kwargs)
+    kwargs["model"] = kwargs["model"][len(self.model_name_prefix):]
+    return kwargs
+
+  def get_stream_kwargs(self, kwargs):
+
+    kwargs = self.get_request_kwargs(kwargs)
+    kwargs["stream"] = True
+    kwargs["stream_options"] = {"include_usage": True}
+    return kwargs
+
+  def complete(self, timeout, **kwargs):
+
+    # set openai internal max_retries to 1 so that we can log errors to console
+    openai_response = self.get_client().with_options(
+      timeout=timeout, max_retries=1
+    ).with_raw_response.chat.completions.create(**self.get_request_kwargs(kwargs))
+
+    return parse_openai_response(openai_response)
+
+  async def complete_async(self, timeout, **kwargs):
+
+    # set openai internal max_retries to 1 so that we can log errors to console
+    openai_response = await self.get_async_client().with_options(
+      timeout=timeout, max_retries=1
+    ).with_raw_response.chat.completions.create(**self.get_request_kwargs(kwargs))
+
+    return parse_openai_response(openai_response)
+
+  def complete_stream(self, timeout, is_complete=None, **kwargs):
+
+    accumulator = StreamAccumulator(is_complete)
+    stream = self.get_client().with_options(
+      timeout=timeout, max_retries=1
+    ).chat.completions.create(**self.get_stream_kwargs(kwargs))
+
+    try:
+      for chunk in stream:
+        if accumulator.add_openai_chunk(chunk):
+          break
+    finally:
+      stream.close()   # stops the generation early
+
+    return accumulator.get_result()
+
+  async def complete_stream_async(self, timeout, is_complete=None, **kwargs):
+
+    accumulator = StreamAccumulator(is_complete)
+    stream = await self.get_async_client().with_options(
+      timeout=timeout, max_retries=1
+    ).chat.completions.create(**self.get_stream_kwargs(kwargs))
+
+    try:
+      async for chunk in stream:
+        if accumulator.add_openai_chunk(chunk):
+          break
+    finally:
+      await stream.close()
+
+    return accumulator.get_result()
+
+# / class OpenAIBackend(LLMBackend):
+
+
+class OpenAICompatibleBackend(OpenAIBackend):
+  """Any local or third party HTTP server implementing the OpenAI chat completions API, for example vLLM, llama.cpp server or Ollama.
+  Model names of the form "local/<model>" are sent to the server as "<model>"."""
+
+  def __init__(self, base_url, api_key_env_var="LOCAL_LLM_API_KEY", model_name_prefix="local/"):
+    super(OpenAICompatibleBackend, self).__init__(api_key_env_var=api_key_env_var, base_url=base_url, model_name_prefix=model_name_prefix)
+
+  def get_client(self):
+
+    if os.getenv(self.api_key_env_var) is None:
+      os.environ[self.api_key_env_var] = "none"   # local servers usually do not need a key, but the OpenAI client refuses to start without one
+
+    return super(OpenAICompatibleBackend, self).get_client()
+
+  def get_async_client(self):
+
+    if os.getenv(self.api_key_env_var) is None:
+      os.environ[self.api_key_env_var] = "none"
+
+    return super(OpenAICompatibleBackend, self).get_async_client()
+
+# / class OpenAICompatibleBackend(OpenAIBackend):
+
+
+claude_prompt_caching_headers = {"anthropic-beta": "prompt-caching-2024-07-31"}   # ignored by the API versions where prompt caching is generally available
+
+
+def add_cache_breakpoint(content):
+  """Returns the message content as a list of content blocks where the last block is marked as a prompt cache breakpoint"""
+
+  if isinstance(content, str):
+    content = [{"type": "text", "text": content}]
+
+  content = list(content)
+  content[-1] = dict(content[-1], cache_control={"type": "ephemeral"})
+  return content
+
+# / def add_cache_breakpoint(content):
+
+
+def build_claude_request(kwargs, prompt_caching=False):
+  """Converts OpenAI style chat completion arguments to Claude messages API arguments.
+  With prompt caching, breakpoints are placed after the system prompt and after the latest message. The breakpoint of the previous step then lies inside the current prefix, so the whole earlier conversation is read from the cache. The message history itself is not modified."""
+
+  messages = kwargs.get('messages', [])
+  system_message = next((msg['content'] for msg in messages if msg['role'] == 'system'), None)
+
+  # Build the messages for Claude
+  claude_messages = [msg for msg in messages if msg['role'] != 'system']
+
+  if prompt_caching:
+    if system_message is not None:
+      system_message = add_cache_breakpoint(system_message)
+    if claude_messages:
+      claude_messages[-1] = dict(claude_messages[-1], content=add_cache_breakpoint(claude_messages[-1]['content']))
+
+  request = dict(
+    model=kwargs['model'],
+    system=system_message,
+    messages=claude_messages,
+    max_tokens=kwargs.get('max_tokens', 1024),
+    temperature=kwargs.get('temperature', 0)
+  )
+
+  if kwargs.get('stop'):
+    request["stop_sequences"] = list(kwargs['stop'])
+
+  response_format = kwargs.get('response_format')
+  if response_format is not None and response_format["type"] == "json_schema":
+    # Claude has no response format option, instead the response is forced to be a call of a tool with the same input schema
+    json_schema = response_format["json_schema"]
+    request["tools"] = [{
+      "name": json_schema["name"],
+      "description": json_schema.get("description", "Submit the response"),
+      "input_schema": json_schema["schema"],
+    }]
+    request["tool_choice"] = {"type": "tool", "name": json_schema["name"]}
+
+  if prompt_caching:
+    request["extra_headers"] = claude_prompt_caching_headers
+
+  return request
+
+# / def build_claude_request(kwargs, prompt_caching=False):
+
+
+def get_claude_count_tokens_kwargs(model_name, messages):
+
+  system_message = next((msg['content'] for msg in messages if msg['role'] == 'system'), None)
+  # Build the messages for Claude
+  claude_messages = [msg for msg in messages if msg['role'] != 'system']
+
+  return dict(
+    model=model_name,
+    system=system_message,
+    messages=claude_messages,
+  )
+
+# / def get_claude_count_tokens_kwargs(model_name, messages):
+
+
+def parse_claude_response(response):
+
+  usage = response.usage
+  cached_input_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+  cache_creation_input_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+
+  usage = {
+    "input_tokens": usage.input_tokens + cached_input_tokens + cache_creation_input_tokens,   # Claude reports the cached part of the input separately
+    "output_tokens": usage.output_tokens,
+    "cached_input_tokens": cached_input_tokens,
+  }
+
+  return (get_claude_response_text(response.content), response.stop_reason, usage)
+
+# / def parse_claude_response(response):
+
+
+def get_claude_response_text(content_blocks):
+  """Returns the text of the response. A tool call, used for structured output, is returned as its JSON input"""
+
+  for block in content_blocks:
+    if block.type == "tool_use":
+      return json.dumps(block.input)
+
+  return "".join(block.text for block in content_blocks if block.type == "text")
+
+# / def get_claude_response_text(content_blocks):
+
+
+class AnthropicBackend(LLMBackend):
+
+  supports_token_counting = True
+
+  def __init__(self, api_key_env_var="ANTHROPIC_API_KEY", prompt_caching=True):
+    super(AnthropicBackend, self).__init__()
+    self.api_key_env_var = api_key_env_var
+    self.prompt_caching = prompt_caching
+
+  def get_client(self):
+
+    with self.lock:
+      if self.client is None:
+        from anthropic import Anthropic
+        self.client = Anthropic(api_key=os.getenv(self.api_key_env_var))
+        print("Initialized Claude client")
+
+    return self.client
+
+  def get_async_client(self):
+
+    if self.async_client is None:
+      from anthropic import AsyncAnthropic
+      self.async_client = AsyncAnthropic(api_key=os.getenv(self.api_key_env_var), http_client=get_async_http_client())
+
+    return self.async_client
+
+  def complete(self, timeout, **kwargs):
+
+    response = self.get_client().with_options(
+      timeout=timeout
+    ).messages.create(**build_claude_request(kwargs, self.prompt_caching))
+
+    return parse_claude_response(response)
+
+  async def complete_async(self, timeout, **kwargs):
+
+    response = await self.get_async_client().with_options(
+      timeout=timeout
+    ).messages.create(**build_claude_request(kwargs, self.prompt_caching))
+
+    return parse_claude_response(response)
+
+  def complete_stream(self, timeout, is_complete=None, **kwargs):
+
+    accumulator = StreamAccumulator(is_complete)
+    stream = self.get_client().with_options(
+      timeout=timeout
+    ).messages.create(stream=True, **build_claude_request(kwargs, self.prompt_caching))
+
+    try:
+      for event in stream:
+        if accumulator.add_claude_event(event):
+          break
+    finally:
+      stream.close()   # stops the generation early
+
+    return accumulator.get_result()
+
+  async def complete_stream_async(self, timeout, is_complete=None, **kwargs):
+
+    accumulator = StreamAccumulator(is_complete)
+    stream = await self.get_async_client().with_options(
+      timeout=timeout
+    ).messages.create(stream=True, **build_claude_request(kwargs, self.prompt_caching))
+
+    try:
+      async for event in stream:
+        if accumulator.add_claude_event(event):
+          break
+    finally:
+      await stream.close()
+
+    return accumulator.get_result()
+
+  def count_tokens(self, model_name, messages):
+
+    response = self.get_client().messages.count_tokens(
+      **get_claude_count_tokens_kwargs(model_name, messages)
+    )
+    return response.input_tokens
+
+  async def count_tokens_async(self, model_name, messages):
+
+    response = await self.get_async_client().messages.count_tokens(
+      **get_claude_count_tokens_kwargs(model_name, messages)
+    )
+    return response.input_tokens
+
+# / class AnthropicBackend(LLMBackend):
+
+
+homeostatic_target_regex = re.compile(r"Homeostatic target(?: ([A-Z]+))?: (-?\d+)")
+homeostatic_actual_regex = re.compile(r"Homeostatic actual(?: ([A-Z]+))?: (-?\d+)")
+amount_food_regex = re.compile(r"Number of potatoes in the environment: (\d+)")
+
+
+class ScriptedPolicyBackend(LLMBackend):
+  """In-process policy that answers the benchmark observations without any LLM. Used for load testing, profiling and running the harness without network access.
+  Model names have the form "scripted/<policy>" or "scripted/<policy>:<parameter>":
+    scripted/constant:N - consumes N units of each resource, but never more than is available
+    scripted/random:N - consumes a random amount between 0 and N units of each resource, but never more than is available. The amounts depend only on the seed, the messages and the candidate index, so that the results do not depend on the scheduling of the trials
+    scripted/proportional:GAIN - consumes GAIN * (homeostatic target - homeostatic actual) for each objective. In the sustainability benchmark, harvests GAIN * available potatoes"""
+
+  cacheable = False   # cheaper to recompute than to store
+  supports_multiple_candidates = True   # the candidates are computed in-process
+
+  default_parameters = {
+    "constant": 1,
+    "random": 10,
+    "proportional": 1.0,
+  }
+
+  def __init__(self, seed=0):
+    super(ScriptedPolicyBackend, self).__init__()
+    self.seed = seed
+
+  def get_random(self, messages, candidate_index):
+    """Returns a random number generator seeded from the request. NB! A generator shared by the requests would make the results depend on the order in which the concurrently running trials send their requests"""
+
+    request_text = json.dumps([self.seed, list(messages), candidate_index], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return random.Random(request_text)   # str seeds are hashed with SHA-512, so the sequence does not depend on PYTHONHASHSEED
+
+  def get_policy(self, model_name):
+
+    policy = model_name.split("/", 1)[1]
+    if ":" in policy:
+      policy, parameter = policy.split(":", 1)
+      parameter = float(parameter)
+    else:
+      parameter = self.default_parameters.get(policy)
+
+    if policy not in self.default_parameters:
+      raise ValueError("Unknown scripted policy: " + policy)
+
+    return policy, parameter
+
+  def get_actions(self, policy, parameter, observation, rng):
+
+    targets = [int(value) for label, value in homeostatic_target_regex.findall(observation)]
+    actuals = [int(value) for label, value in homeostatic_actual_regex.findall(observation)]
+    amount_food = amount_food_regex.search(observation)
+
+    if targets and len(targets) == len(actuals):  # homeostasis benchmarks
+      if policy == "constant":
+        return [int(parameter)] * len(targets)
+      elif policy == "random":
+        return [rng.randint(0, int(parameter)) for _ in targets]
+      else:
+        return [max(0, int(round(parameter * (target - actual)))) for target, actual in zip(targets, actuals)]
+
+    elif amount_food is not None:   # sustainability benchmark
+      amount_food = int(amount_food.group(1))
+      if policy == "constant":
+        return [min(int(parameter), amount_food)]
+      elif policy == "random":
+        return [rng.randint(0, min(int(parameter), amount_food))]
+      else:
+        return [int(parameter * amount_food)]
+
+    else:
+      return [int(parameter) if policy == "constant" else 0]
+
+  def complete(self, timeout, **kwargs):
+
+    policy, parameter = self.get_policy(kwargs["model"])
+    messages = kwargs["messages"]
+    observation = messages[-1]["content"]
+
+    results = []
+    for candidate_index in range(kwargs.get("n", 1)):
+      rng = self.get_random(messages, candidate_index) if policy == "random" else None
+      actions = self.get_actions(policy, parameter, observation, rng)
+      results.append((", ".join(str(action) for action in actions), "stop", None))
+
+    if len(results) == 1:
+      return results[0]
+    else:
+      return merge_candidate_results(results)
+
+  async def complete_async(self, timeout, **kwargs):
+    return self.complete(timeout, **kwargs)
+
+# / class ScriptedPolicyBackend(LLMBackend):
+
+
+backend_factories = []   # list of (model name prefix, factory function) tuples
+backends = {}   # backend instances by model name prefix
+backends_lock = threading.Lock()
+
+
+def register_backend(model_name_prefix, factory):
+  """Registers a backend for the model names starting with the given prefix. The factory is called once, on first use of the backend. Longer prefixes take precedence."""
+
+  with backends_lock:
+    backend_factories.append((model_name_prefix, factory))
+    backend_factories.sort(key=lambda entry: len(entry[0]), reverse=True)
+    backends.pop(model_name_prefix, None)
+
+# / def register_backend(model_name_prefix, factory):
+
+
+def get_backend(model_name):
+
+  for model_name_prefix, factory in backend_factories:
+    if model_name.lower().startswith(model_name_prefix):
+      break
+  else:
+    raise ValueError(f"Unsupported model: {model_name}")
+
+  backend = backends.get(model_name_prefix)
+  if backend is None:
+    with backends_lock:
+      backend = backends.get(model_name_prefix)
+      if backend is None:
+        backend = factory()
+        backends[model_name_prefix] = backend
+
+  return backend
+
+# / def get_backend(model_name):
+
+
+def register_default_backends(local_base_url=None, prompt_caching=True):
+
+  openai_backend = None
+
+  def get_openai_backend():
+    nonlocal openai_backend
+    if openai_backend is None:
+      openai_backend = OpenAIBackend()
+    return openai_backend
+
+  # all OpenAI model families share one client
+  for model_name_prefix in ["gpt", "o1", "o3", "chatgpt"]:
+    register_backend(model_name_prefix, get_openai_backend)
+
+  register_backend("claude", lambda: AnthropicBackend(prompt_caching=prompt_caching))
+  register_backend("scripted/", ScriptedPolicyBackend)
+  if local_base_url is not None:
+    register_backend("local/", lambda: OpenAICompatibleBackend(local_base_url))
+
+# / def register_default_backends(local_base_url=None, prompt_caching=True):
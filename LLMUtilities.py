@@ -5,181 +5,289 @@
 # Repository: https://github.com/levitation-opensource/bioblue
 
 import os
+import re
 import time
+import threading
+import functools
+import hashlib
+from collections import deque, OrderedDict
 
-import tenacity
-import tiktoken
-
-import traceback
-import httpcore
-import httpx
 import json
-import json_tricks
-
-from openai import OpenAI
-from anthropic import Anthropic
 
-from Utilities import Timer, wait_for_enter
+from Utilities import Timer, wait_for_enter, data_dir
+from CompletionCache import CompletionCache
+import LLMBackends
+from LLMBackends import (
+  register_backend,
+  close_async_clients,
+)
 # from dotenv import load_dotenv
 # load_dotenv()  # Load variables from .env file
 
-import configparser
-import ast
+
+# NB! The heavy modules (tenacity, tiktoken, httpx, the provider SDKs) are imported and config.ini is read only on first use, so that importing this module stays cheap for the tools and worker processes which need only some of its functions. See ImportTimes.py
 
 
 config_path = r"config.ini" 
-config = configparser.ConfigParser()
-config.read_file(open(config_path))
 
-model_name = ast.literal_eval(config.get('Model params', 'name'))
+config_values = {   # name: (section, option, fallback). Available as module attributes, for example LLMUtilities.model_name
+  "model_name": ('Model params', 'name', None),
+  "use_provider_token_counts": ('Model params', 'provider_token_counts', 'False'),   # query Claude's count_tokens endpoint instead of counting the input tokens locally
+  "use_streaming": ('Model params', 'streaming', 'False'),   # stream the responses and stop the generation as soon as a complete action has been received
+  "stop_sequences": ('Model params', 'stop_sequences', 'None'),
+  "use_structured_output": ('Model params', 'structured_output', 'False'),   # constrain the responses to the JSON schema of the action
+  "local_base_url": ('Model params', 'local_base_url', 'None'),   # OpenAI compatible server used for the "local/<model>" model names
+  "prompt_caching": ('Model params', 'prompt_caching', 'True'),   # place Claude prompt cache breakpoints. OpenAI caches the prompt prefixes automatically
+
+  "use_completion_cache": ('Cache params', 'enabled', 'True'),
+  "completion_cache_max_size_mb": ('Cache params', 'max_size_mb', '1024'),
+  "completion_cache_replay": ('Cache params', 'replay', 'False'),   # use the cache also for the sampled requests with a nonzero temperature, in order to reproduce an earlier run
+
+  "context_window_max_tokens": ('Context window params', 'max_tokens', 'None'),
+  "context_window_max_steps": ('Context window params', 'max_steps', 'None'),
+  "context_window_trim_ratio": ('Context window params', 'trim_ratio', 'None'),   # None means ContextWindowPolicy.default_trim_ratio
+
+  "checkpoint_every_steps": ('Checkpoint params', 'every_steps', '1'),   # None disables the checkpoints of the steps
+
+  "download_tokenizers": ('Tokenizer params', 'download', 'True'),   # let tiktoken download the encodings which are not in data/tokenizers
+}
+
+completion_cache_fname = "completions_cache.sqlite"
+
+
+def literal_eval(text):
+  import ast
+  return ast.literal_eval(text)
+
+
+@functools.lru_cache(maxsize=None)
+def get_config():
+  """Reads config.ini and registers the default backends with the configured options"""
+
+  import configparser   # NB! the modules which are needed only on first use are imported then, in order to keep the startup fast. See ImportTimes.py
+  config = configparser.ConfigParser()
+  with open(config_path) as fh:
+    config.read_file(fh)
+
+  LLMBackends.register_default_backends(
+    local_base_url=literal_eval(config.get(*config_values["local_base_url"][:2], fallback=config_values["local_base_url"][2])),
+    prompt_caching=literal_eval(config.get(*config_values["prompt_caching"][:2], fallback=config_values["prompt_caching"][2])),
+  )
+
+  return config
+
+# / def get_config():
+
+
+@functools.lru_cache(maxsize=None)
+def get_config_value(name):
+
+  section, option, fallback = config_values[name]
+  if fallback is None:
+    return literal_eval(get_config().get(section, option))
+  else:
+    return literal_eval(get_config().get(section, option, fallback=fallback))
+
+# / def get_config_value(name):
+
+
+def __getattr__(name):   # module attributes for the config values, read on first access
+
+  if name in config_values:
+    return get_config_value(name)
+
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# / def __getattr__(name):
+
+
+def get_backend(model_name):
+  get_config()   # the default backends are registered when the config is read
+  return LLMBackends.get_backend(model_name)
+
+
+def handle_completion_exception(ex, attempt_number, max_attempt_number):
+  """Prints the error. Returns True when the user should confirm before the request is retried"""
+
+  import httpcore
+  import httpx
+
+  t = type(
+    ex
+  )  
+  if (
+    t is httpcore.ReadTimeout or t is httpx.ReadTimeout
+  ):  # both exception types have occurred
+    if attempt_number < max_attempt_number:
+      print("Read timeout, retrying...")
+    else:
+      print("Read timeout, giving up")
+
+  elif t is httpcore.NetworkError:
+    if attempt_number < max_attempt_number:
+      print("Network error, retrying...")
+    else:
+      print("Network error, giving up")
+
+  elif t is json.decoder.JSONDecodeError:
+    if attempt_number < max_attempt_number:
+      print("Response format error, retrying...")
+    else:
+      print("Response format error, giving up")
+
+  else:  # / if (t ishttpcore.ReadTimeout
+    import traceback
+    msg = f"{str(ex)}\n{traceback.format_exc()}"
+    print(msg)
+
+    if attempt_number < max_attempt_number:
+      return True
+    else:
+      print("Giving up")
+
+  # / if (t ishttpcore.ReadTimeout
+
+  return False
 
-# Initialize the appropriate client based on the model name
-if model_name.lower().startswith('claude'):
-    from anthropic import Anthropic  
-    claude_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-    print("Initialized Claude client")
-elif model_name.lower().startswith('gpt'):
-    from openai import OpenAI  
-    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    print("Initialized OpenAI client")
-else:
-    print(f"Unsupported model: {model_name}")
+# / def handle_completion_exception(ex, attempt_number, max_attempt_number):
 
 
 ## https://platform.openai.com/docs/guides/rate-limits/error-mitigation
 # TODO: config parameter for max attempt number
-@tenacity.retry(
-  wait=tenacity.wait_random_exponential(min=1, max=60),
-  stop=tenacity.stop_after_attempt(10),
-)  # TODO: config parameters
+@functools.lru_cache(maxsize=None)
+def get_completion_retry_policy():
+  """Returns the tenacity wait and stop policies"""
+
+  import tenacity
+
+  completion_retry_wait = tenacity.wait_random_exponential(min=1, max=60)  # TODO: config parameters
+  completion_retry_stop = tenacity.stop_after_attempt(10)
+  return completion_retry_wait, completion_retry_stop
+
+# / def get_completion_retry_policy():
+
+
 def completion_with_backoff(
-  gpt_timeout, **kwargs
+  gpt_timeout, is_stream_complete=None, **kwargs
 ):  # TODO: ensure that only HTTP 429 is handled here
   # return openai.ChatCompletion.create(**kwargs)
 
-  attempt_number = completion_with_backoff.retry.statistics["attempt_number"]
-  max_attempt_number = completion_with_backoff.retry.stop.max_attempt_number
-  timeout_multiplier = 2 ** (attempt_number - 1)  # increase timeout exponentially
+  import tenacity
 
-  try:
-    timeout = gpt_timeout * timeout_multiplier
+  completion_retry_wait, completion_retry_stop = get_completion_retry_policy()
+  retrying = tenacity.Retrying(
+    wait=completion_retry_wait,
+    stop=completion_retry_stop,
+  )
+  max_attempt_number = completion_retry_stop.max_attempt_number
 
-    # print(f"Sending OpenAI API request... Using timeout: {timeout} seconds")
+  for attempt in retrying:
+    with attempt:
 
-    # TODO!!! support for other LLM API-s
-    is_claude = model_name.startswith('claude-')
-    if is_claude:
-    
-      messages = kwargs.pop('messages', [])
-      system_message = next((msg['content'] for msg in messages if msg['role'] == 'system'), None)
-        
-      # Build the messages for Claude
-      claude_messages = []
-      claude_messages = [msg for msg in messages if msg['role'] != 'system']
-      response = claude_client.messages.create(
-        model=kwargs['model'],
-        system=system_message,
-        messages=claude_messages,
-        max_tokens=kwargs.get('max_tokens', 1024),
-        temperature=kwargs.get('temperature', 0)
-      )
-      return (response.content[0].text, response.stop_reason)
-      
-    else:
+      attempt_number = attempt.retry_state.attempt_number
+      timeout_multiplier = 2 ** (attempt_number - 1)  # increase timeout exponentially
 
-      # TODO!!! support for local LLM-s
-      #
+      try:
+        timeout = gpt_timeout * timeout_multiplier
 
-      # set openai internal max_retries to 1 so that we can log errors to console
-      openai_response = openai_client.with_options(
-        timeout=gpt_timeout, max_retries=1
-      ).with_raw_response.chat.completions.create(**kwargs)
+        # print(f"Sending API request... Using timeout: {timeout} seconds")
 
-      # print("Done OpenAI API request.")
+        backend = get_backend(kwargs["model"])
+        if kwargs.get("n", 1) > 1 and not backend.supports_multiple_candidates:
+          return backend.complete_candidates(timeout, **kwargs)
+        elif kwargs.get("stream"):
+          return backend.complete_stream(timeout, is_stream_complete, **kwargs)
+        else:
+          return backend.complete(timeout, **kwargs)
 
-      openai_response = json_tricks.loads(
-        openai_response.content.decode("utf-8", "ignore")
-      )
+      except Exception as ex: 
 
-      if openai_response.get("error"):
-        if (
-          openai_response["error"]["code"] == 502
-          or openai_response["error"]["code"] == 503
-        ):  # Bad gateway or Service Unavailable
-          raise httpcore.NetworkError(openai_response["error"]["message"])
-        else:
-          raise Exception(
-            str(openai_response["error"]["code"])
-            + " : "
-            + openai_response["error"]["message"]
-          )  # TODO: use a more specific exception type
+        if handle_completion_exception(ex, attempt_number, max_attempt_number):
+          wait_for_enter("Press any key to retry")
+
+        raise
+
+      # / except Exception as ex:
 
-      # NB! this line may also throw an exception if the OpenAI announces that it is overloaded # TODO: do not retry for all error messages
-      response_content = openai_response["choices"][0]["message"]["content"]
-      finish_reason = openai_response["choices"][0]["finish_reason"]
+    # / with attempt:
+  # / for attempt in retrying:
 
-      return (response_content, finish_reason)
+# / def completion_with_backoff(gpt_timeout, is_stream_complete=None, **kwargs):
 
-  except Exception as ex: 
-    t = type(
-      ex
-    )  
-    if (
-      t is httpcore.ReadTimeout or t is httpx.ReadTimeout
-    ):  # both exception types have occurred
-      if attempt_number < max_attempt_number:
-        print("Read timeout, retrying...")
-      else:
-        print("Read timeout, giving up")
 
-    elif t is httpcore.NetworkError:
-      if attempt_number < max_attempt_number:
-        print("Network error, retrying...")
-      else:
-        print("Network error, giving up")
+async def completion_with_backoff_async(
+  gpt_timeout, is_stream_complete=None, **kwargs
+):
+  """Async counterpart of completion_with_backoff. Uses the same retry and timeout policy, but the retry state is kept per call so that any number of calls can be awaited concurrently on one event loop"""
+
+  import asyncio
+  import tenacity
+
+  backend = get_backend(kwargs["model"])
+
+  completion_retry_wait, completion_retry_stop = get_completion_retry_policy()
+  retrying = tenacity.AsyncRetrying(
+    wait=completion_retry_wait,
+    stop=completion_retry_stop,
+    reraise=True,
+  )
+  max_attempt_number = completion_retry_stop.max_attempt_number
 
-    elif t is json.decoder.JSONDecodeError:
-      if attempt_number < max_attempt_number:
-        print("Response format error, retrying...")
-      else:
-        print("Response format error, giving up")
+  async for attempt in retrying:
+    with attempt:
 
-    else:  # / if (t ishttpcore.ReadTimeout
-      msg = f"{str(ex)}\n{traceback.format_exc()}"
-      print(msg)
+      attempt_number = attempt.retry_state.attempt_number
+      timeout_multiplier = 2 ** (attempt_number - 1)  # increase timeout exponentially
 
-      if attempt_number < max_attempt_number:
-        wait_for_enter("Press any key to retry")
-      else:
-        print("Giving up")
+      try:
+        timeout = gpt_timeout * timeout_multiplier
 
-    # / if (t ishttpcore.ReadTimeout
+        if kwargs.get("n", 1) > 1 and not backend.supports_multiple_candidates:
+          return await backend.complete_candidates_async(timeout, **kwargs)
+        elif kwargs.get("stream"):
+          return await backend.complete_stream_async(timeout, is_stream_complete, **kwargs)
+        else:
+          return await backend.complete_async(timeout, **kwargs)
+
+      except Exception as ex:
+
+        if handle_completion_exception(ex, attempt_number, max_attempt_number):
+          await asyncio.to_thread(wait_for_enter, "Press any key to retry")   # do not block the other requests running on the event loop
 
-    raise
+        raise
 
-  # / except Exception as ex:
+      # / except Exception as ex:
 
-# / def completion_with_backoff(gpt_timeout, **kwargs):
+    # / with attempt:
+  # / async for attempt in retrying:
 
+# / async def completion_with_backoff_async(gpt_timeout, is_stream_complete=None, **kwargs):
 
+
+@functools.lru_cache(maxsize=None)   # the encoding objects are expensive to look up and construct, so construct each only once
 def get_encoding_for_model(model):
-  try:
-    encoding = tiktoken.encoding_for_model(model)
-  except KeyError:
-    print("Warning: model not found. Using cl100k_base encoding.")
-    encoding = tiktoken.get_encoding("cl100k_base")
+  """Returns the tiktoken encoding of the model from data/tokenizers, or an approximate token counter for the models without a known or available encoding. See Tokenizers.py"""
+
+  import Tokenizers
 
-  return encoding
+  return Tokenizers.get_encoding_for_model(model, allow_download=get_config_value("download_tokenizers"))
 
 # / def get_encoding_for_model(model):
 
 
-# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages, model, encoding=None):
-  """Return the number of tokens used by a list of messages."""
+def warm_up_encodings(model_names):
+  """Loads the encodings of the models once at the process start, so that the trials do not pay for it at their first step"""
 
-  if encoding is None:
-    encoding = get_encoding_for_model(model)
+  for model_name in model_names:
+    get_encoding_for_model(model_name)
+
+# / def warm_up_encodings(model_names):
+
+
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+@functools.lru_cache(maxsize=None)
+def get_message_token_overheads(model):
+  """Returns the number of extra tokens used per message and per name field."""
 
   if model in {
     "gpt-3.5-turbo-0125",
@@ -203,37 +311,27 @@ def num_tokens_from_messages(messages, model, encoding=None):
 
   elif "gpt-3.5-turbo-16k" in model:  # roland
     # print("Warning: gpt-3.5-turbo-16k may update over time. Returning num tokens assuming gpt-3.5-turbo-16k-0613.")
-    return num_tokens_from_messages(
-      messages, model="gpt-3.5-turbo-16k-0613", encoding=encoding
-    )
+    return get_message_token_overheads("gpt-3.5-turbo-16k-0613")
 
   elif "gpt-3.5-turbo" in model:
     # print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-    return num_tokens_from_messages(
-      messages, model="gpt-3.5-turbo-0613", encoding=encoding
-    )
+    return get_message_token_overheads("gpt-3.5-turbo-0613")
 
   elif "gpt-4-32k" in model:  # roland
     # print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-32k-0613.")
-    return num_tokens_from_messages(
-      messages, model="gpt-4-32k-0613", encoding=encoding
-    )
+    return get_message_token_overheads("gpt-4-32k-0613")
 
   elif "gpt-4o-mini" in model:
     # print("Warning: gpt-4o-mini may update over time. Returning num tokens assuming gpt-4o-mini-2024-07-18.")
-    return num_tokens_from_messages(
-      messages, model="gpt-4o-mini-2024-07-18", encoding=encoding
-    )
+    return get_message_token_overheads("gpt-4o-mini-2024-07-18")
 
   elif "gpt-4o" in model:
     # print("Warning: gpt-4o and gpt-4o-mini may update over time. Returning num tokens assuming gpt-4o-2024-08-06.")
-    return num_tokens_from_messages(
-      messages, model="gpt-4o-2024-08-06", encoding=encoding
-    )
+    return get_message_token_overheads("gpt-4o-2024-08-06")
 
   elif "gpt-4" in model:
     # print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-    return num_tokens_from_messages(messages, model="gpt-4-0613", encoding=encoding)
+    return get_message_token_overheads("gpt-4-0613")
 
   else:
     # raise NotImplementedError(
@@ -244,21 +342,48 @@ def num_tokens_from_messages(messages, model, encoding=None):
     tokens_per_message = 4
     tokens_per_name = 1
 
-  num_tokens = 0
-  for message in messages:
-    num_tokens += tokens_per_message
+  return tokens_per_message, tokens_per_name
+
+# / def get_message_token_overheads(model):
+
+
+def num_tokens_from_message(message, model, encoding=None):
+  """Return the number of tokens used by a single message, excluding the reply priming tokens."""
+
+  if encoding is None:
+    encoding = get_encoding_for_model(model)
+
+  tokens_per_message, tokens_per_name = get_message_token_overheads(model)
+
+  num_tokens = tokens_per_message
+
+  for key, value in message.items():
+    if key == "weight":
+      continue
+
+    num_tokens += len(encoding.encode(value))
+    if key == "name":
+      num_tokens += tokens_per_name
+
+  # / for key, value in message.items():
+
+  return num_tokens
+
+# / def num_tokens_from_message(message, model, encoding=None):
+
 
-    for key, value in message.items():
-      if key == "weight":
-        continue
+def num_tokens_from_messages(messages, model, encoding=None):
+  """Return the number of tokens used by a list of messages."""
 
-      num_tokens += len(encoding.encode(value))
-      if key == "name":
-        num_tokens += tokens_per_name
+  if isinstance(messages, MessageHistory) and messages.model == model and encoding is None:
+    return messages.num_tokens   # already counted incrementally
 
-    # / for key, value in message.items():
+  if encoding is None:
+    encoding = get_encoding_for_model(model)
 
-  # / for message in messages:
+  num_tokens = 0
+  for message in messages:
+    num_tokens += num_tokens_from_message(message, model, encoding)
 
   num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
 
@@ -267,6 +392,149 @@ def num_tokens_from_messages(messages, model, encoding=None):
 # / def num_tokens_from_messages(messages, model, encoding=None):
 
 
+class MessageHistory(deque):
+  """Message deque with a token ledger. 
+  The token count of each message is computed once when the message is added, so that the total token count of the history is updated in O(1) time on append and popleft. 
+  NB! Only the methods overridden below keep the token count up to date."""
+
+  def __init__(self, model, messages=()):
+    super(MessageHistory, self).__init__()
+    self.model = model
+    self.encoding = get_encoding_for_model(model)
+    self.message_token_counts = deque()
+    self.num_message_tokens = 0
+    self.extend(messages)
+
+  def __reduce__(self):   # used by pickle and copy
+    return (self.__class__, (self.model, list(self)))
+
+  def copy(self):   # copies also the token counts instead of counting them again
+    result = self.__class__(self.model)
+    deque.extend(result, self)
+    result.message_token_counts = self.message_token_counts.copy()
+    result.num_message_tokens = self.num_message_tokens
+    return result
+
+  @property
+  def num_tokens(self):
+    return self.num_message_tokens + 3  # every reply is primed with <|start|>assistant<|message|>
+
+  def append(self, message):
+    num_tokens = num_tokens_from_message(message, self.model, self.encoding)
+    super(MessageHistory, self).append(message)
+    self.message_token_counts.append(num_tokens)
+    self.num_message_tokens += num_tokens
+
+  def appendleft(self, message):
+    num_tokens = num_tokens_from_message(message, self.model, self.encoding)
+    super(MessageHistory, self).appendleft(message)
+    self.message_token_counts.appendleft(num_tokens)
+    self.num_message_tokens += num_tokens
+
+  def extend(self, messages):
+    for message in messages:
+      self.append(message)
+
+  def insert(self, index, message):
+    num_tokens = num_tokens_from_message(message, self.model, self.encoding)
+    super(MessageHistory, self).insert(index, message)
+    self.message_token_counts.insert(index, num_tokens)
+    self.num_message_tokens += num_tokens
+
+  def pop(self):
+    message = super(MessageHistory, self).pop()
+    self.num_message_tokens -= self.message_token_counts.pop()
+    return message
+
+  def popleft(self):
+    message = super(MessageHistory, self).popleft()
+    self.num_message_tokens -= self.message_token_counts.popleft()
+    return message
+
+  def __delitem__(self, index):
+    super(MessageHistory, self).__delitem__(index)
+    self.num_message_tokens -= self.message_token_counts[index]
+    del self.message_token_counts[index]
+
+  def clear(self):
+    super(MessageHistory, self).clear()
+    self.message_token_counts.clear()
+    self.num_message_tokens = 0
+
+# / class MessageHistory(deque):
+
+
+class ContextWindowPolicy(object):
+  """Limits the conversation history sent to the LLM. 
+  The first num_pinned_messages messages (the system prompt) are always kept. When the history exceeds max_tokens tokens or max_steps steps, the oldest observation-action pairs after the pinned messages are dropped. 
+  The history is then trimmed down to trim_ratio of the limits, so that the dropping happens only once in a while. In between, the conversation stays append-only and its prefix is byte-identical from step to step, which lets the provider serve it from the prompt cache. With trim_ratio = 1 a pair is dropped at nearly every step once the limit is reached, and each drop invalidates the cached prefix.
+  With MessageHistory each drop takes constant time. Other message lists are counted again after each drop, with the encoding of model_name."""
+
+  default_trim_ratio = 0.75
+
+  def __init__(self, max_tokens=None, max_steps=None, num_pinned_messages=1, trim_ratio=None, model_name=None):
+    self.max_tokens = max_tokens
+    self.max_steps = max_steps
+    self.num_pinned_messages = num_pinned_messages
+    self.trim_ratio = trim_ratio if trim_ratio is not None else self.default_trim_ratio
+    self.model_name = model_name
+
+  def get_num_tokens(self, messages):
+
+    if isinstance(messages, MessageHistory):
+      return messages.num_tokens   # already counted incrementally
+
+    if self.model_name is None:
+      raise ValueError("ContextWindowPolicy needs a model_name in order to count the tokens of a message list which is not a MessageHistory")
+
+    return num_tokens_from_messages(messages, self.model_name)
+
+  def is_over_limit(self, messages, ratio=1.0):
+
+    if self.max_tokens is not None and self.get_num_tokens(messages) > self.max_tokens * ratio:
+      return True
+
+    num_steps = (len(messages) - self.num_pinned_messages + 1) // 2   # the latest observation does not have an action yet
+    if self.max_steps is not None and num_steps > self.max_steps * ratio:
+      return True
+
+    return False
+
+  def trim(self, messages):
+    """When the messages exceed the limits, drops the oldest observation-action pairs until it fits into trim_ratio of the limits. The latest observation is never dropped. Returns the number of dropped pairs."""
+
+    if not self.is_over_limit(messages):
+      return 0
+
+    num_dropped = 0
+    while len(messages) > self.num_pinned_messages + 1 and self.is_over_limit(messages, self.trim_ratio):
+      del messages[self.num_pinned_messages]  # oldest observation
+      del messages[self.num_pinned_messages]  # oldest action
+      num_dropped += 1
+
+    return num_dropped
+
+# / class ContextWindowPolicy(object):
+
+
+def get_context_window_policy(model_name):
+  """Returns the context window policy configured in config.ini. The token budget never exceeds the model's own limit."""
+
+  max_tokens = get_max_tokens_for_model(model_name)
+  context_window_max_tokens = get_config_value("context_window_max_tokens")
+  if context_window_max_tokens is not None:
+    max_tokens = min(max_tokens, context_window_max_tokens)
+
+  return ContextWindowPolicy(
+    max_tokens=max_tokens,
+    max_steps=get_config_value("context_window_max_steps"),
+    trim_ratio=get_config_value("context_window_trim_ratio"),
+    model_name=model_name,
+  )
+
+# / def get_context_window_policy(model_name):
+
+
 def get_max_tokens_for_model(model_name):
   # TODO: config
   
@@ -388,41 +656,17 @@ def get_max_tokens_for_model(model_name):
 # / def get_max_tokens_for_model(model_name):
 
 
-# TODO: caching support
-def run_llm_completion_uncached(
-  model_name, gpt_timeout, messages, temperature=0, max_output_tokens=100
-):
-  is_claude = model_name.startswith('claude-')
-
-  if is_claude:
-    system_message = next((msg['content'] for msg in messages if msg['role'] == 'system'), None)
-    # Build the messages for Claude
-    claude_messages = []
-    claude_messages = [msg for msg in messages if msg['role'] != 'system']
-    response = claude_client.messages.count_tokens(
-    model=model_name,
-    system=system_message,
-    messages=claude_messages,
-    )
-    num_input_tokens = json.loads(response.json()).get("input_tokens") # TODO
-    # num_input_tokens = 0  # Placeholder as Claude handles this internally
-  else:
-    num_input_tokens = num_tokens_from_messages(
-      messages, model_name
-    )  # TODO: a more precise token count is already provided by OpenAI, no need to recalculate it here
-
-  max_tokens = get_max_tokens_for_model(model_name)
-
-  print(f"num_input_tokens: {num_input_tokens} max_tokens: {max_tokens}")
+def get_completion_kwargs(model_name, messages, temperature, max_output_tokens, action_parser=None, num_candidates=1):
 
-  time_start = time.time()
+  use_streaming = get_config_value("use_streaming")
+  stop_sequences = get_config_value("stop_sequences")
+  use_structured_output = get_config_value("use_structured_output")
 
-  (response_content, finish_reason) = completion_with_backoff(
-    gpt_timeout,
+  kwargs = dict(
     model=model_name,
     messages=messages,
-    n=1,
-    stream=False,
+    n=num_candidates,
+    stream=use_streaming and num_candidates == 1,   # the streaming mode handles one response only
     temperature=temperature,  # 1,   0 means deterministic output  # TODO: increase in case of sampling the GPT multiple times per same text
     top_p=1,
     max_tokens=max_output_tokens,
@@ -431,37 +675,434 @@ def run_llm_completion_uncached(
     # logit_bias = None,
   )
 
-  time_elapsed = time.time() - time_start
+  if stop_sequences:
+    kwargs["stop"] = stop_sequences
+
+  if use_structured_output and action_parser is not None:
+    kwargs["response_format"] = action_parser.get_response_format()
+
+  return kwargs
+
+# / def get_completion_kwargs(model_name, messages, temperature, max_output_tokens, action_parser=None, num_candidates=1):
+
+
+def get_completion_cache_options(action_parser, num_candidates=1):
+  """Returns the request options which change the response text, and therefore need to be part of the completion cache key"""
+
+  use_streaming = get_config_value("use_streaming")
+  stop_sequences = get_config_value("stop_sequences")
+  use_structured_output = get_config_value("use_structured_output")
+
+  options = {}
+  if stop_sequences:
+    options["stop"] = stop_sequences
+  if use_streaming and action_parser is not None:
+    options["stream_until"] = repr(action_parser)   # the stream is closed once the action is complete, so the remaining text is not received
+  if use_structured_output and action_parser is not None:
+    options["response_format"] = action_parser.get_response_format()
+  if num_candidates > 1:
+    options["n"] = num_candidates
+
+  return options
+
+# / def get_completion_cache_options(action_parser, num_candidates=1):
+
+
+provider_token_counts_cache = OrderedDict()
+provider_token_counts_cache_max_size = 10000
+provider_token_counts_lock = threading.Lock()
+
+def get_provider_token_counts_key(model_name, messages):
+
+  request_text = json.dumps([model_name, list(messages)], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+  return hashlib.sha256(request_text.encode("utf-8")).hexdigest()
+
+# / def get_provider_token_counts_key(model_name, messages):
+
+
+def get_cached_provider_token_count(key):
+
+  with provider_token_counts_lock:
+    num_tokens = provider_token_counts_cache.get(key)
+    if num_tokens is not None:
+      provider_token_counts_cache.move_to_end(key)
+
+  return num_tokens
+
+# / def get_cached_provider_token_count(key):
+
+
+def set_cached_provider_token_count(key, num_tokens):
+
+  with provider_token_counts_lock:
+    provider_token_counts_cache[key] = num_tokens
+    if len(provider_token_counts_cache) > provider_token_counts_cache_max_size:
+      provider_token_counts_cache.popitem(last=False)   # drop the least recently used entry
+
+# / def set_cached_provider_token_count(key, num_tokens):
+
+
+def count_input_tokens(model_name, messages):
+  """Counts the input tokens locally. For Claude models the count is approximate unless use_provider_token_counts is enabled, in which case Claude's count_tokens endpoint is queried once per distinct message list."""
+
+  backend = get_backend(model_name)
+
+  if backend.supports_token_counting and get_config_value("use_provider_token_counts"):
+    key = get_provider_token_counts_key(model_name, messages)
+    num_tokens = get_cached_provider_token_count(key)
+    if num_tokens is None:
+      num_tokens = backend.count_tokens(model_name, messages)
+      set_cached_provider_token_count(key, num_tokens)
+    return num_tokens
+
+  return num_tokens_from_messages(messages, model_name)
+
+# / def count_input_tokens(model_name, messages):
+
+
+async def count_input_tokens_async(model_name, messages):
+
+  backend = get_backend(model_name)
 
-  too_long = finish_reason == "length" if not is_claude else finish_reason == "max_tokens"
+  if backend.supports_token_counting and get_config_value("use_provider_token_counts"):
+    key = get_provider_token_counts_key(model_name, messages)
+    num_tokens = get_cached_provider_token_count(key)
+    if num_tokens is None:
+      num_tokens = await backend.count_tokens_async(model_name, messages)
+      set_cached_provider_token_count(key, num_tokens)
+    return num_tokens
+
+  return num_tokens_from_messages(messages, model_name)
+
+# / async def count_input_tokens_async(model_name, messages):
+
+
+def finish_llm_completion(
+  model_name, response_content, finish_reason, usage, num_input_tokens, max_tokens, time_elapsed
+):
+  """Returns the output message and the usage statistics of the completion. When the API did not report the usage, for example because a stream was closed early, the token counts are computed locally."""
+
+  too_long = finish_reason in ("length", "max_tokens")  # OpenAI and Claude respectively
   assert not too_long
 
   output_message = {"role": "assistant", "content": response_content}
-  if is_claude:
-    # print(f"Response Content Format: {type(response_content)}, Content: {response_content}")
-    # #TODO: check if accurate - seems to overestimate tokens
-    num_output_tokens = json.loads(response.json()).get("input_tokens")
-    num_total_tokens = num_input_tokens + num_output_tokens
-    
-  else:
-    num_output_tokens = num_tokens_from_messages(
-      [output_message], model_name
-    )  # TODO: a more precise token count is already provided by OpenAI, no need to recalculate it here
-    num_total_tokens = num_input_tokens + num_output_tokens
+
+  usage = dict(usage or {})
+  if "input_tokens" not in usage:
+    usage["input_tokens"] = num_input_tokens
+  if "output_tokens" not in usage:
+    usage["output_tokens"] = sum(
+      num_tokens_from_messages([{"role": "assistant", "content": candidate}], model_name)
+      for candidate in usage.get("candidates", [response_content])
+    )
+  usage.setdefault("cached_input_tokens", 0)
+
+  usage["time_elapsed"] = time_elapsed
+  usage["output_tokens_per_second"] = usage["output_tokens"] / time_elapsed if time_elapsed > 0 else 0
+
+  num_total_tokens = usage["input_tokens"] + usage["output_tokens"]
 
   print(
-    f"num_total_tokens: {num_total_tokens} num_output_tokens: {num_output_tokens} max_tokens: {max_tokens} performance: {(num_output_tokens / time_elapsed)} output_tokens/sec"
+    f"num_total_tokens: {num_total_tokens} num_output_tokens: {usage['output_tokens']} num_cached_input_tokens: {usage['cached_input_tokens']} max_tokens: {max_tokens} performance: {usage['output_tokens_per_second']} output_tokens/sec"
+  )
+
+  return output_message, usage
+
+# / def finish_llm_completion(model_name, response_content, finish_reason, usage, num_input_tokens, max_tokens, time_elapsed):
+
+
+def run_llm_completion_uncached(
+  model_name, gpt_timeout, messages, temperature=0, max_output_tokens=100, action_parser=None, num_candidates=1
+):
+  num_input_tokens = count_input_tokens(model_name, messages)
+
+  max_tokens = get_max_tokens_for_model(model_name)
+
+  print(f"num_input_tokens: {num_input_tokens} max_tokens: {max_tokens}")
+
+  time_start = time.time()
+
+  (response_content, finish_reason, usage) = completion_with_backoff(
+    gpt_timeout,
+    is_stream_complete=action_parser.is_complete if action_parser is not None else None,
+    **get_completion_kwargs(model_name, messages, temperature, max_output_tokens, action_parser, num_candidates)
+  )
+
+  time_elapsed = time.time() - time_start
+
+  output_message, usage = finish_llm_completion(
+    model_name, response_content, finish_reason, usage, num_input_tokens, max_tokens, time_elapsed
+  )
+
+  return response_content, output_message, usage
+
+# / def run_llm_completion_uncached(model_name, gpt_timeout, messages, temperature = 0, max_output_tokens = 100, action_parser = None, num_candidates = 1):
+
+
+async def run_llm_completion_uncached_async(
+  model_name, gpt_timeout, messages, temperature=0, max_output_tokens=100, action_parser=None, num_candidates=1
+):
+  """Async counterpart of run_llm_completion_uncached. Many of these calls can be awaited concurrently on a single event loop"""
+
+  messages = list(messages) if not isinstance(messages, MessageHistory) else messages.copy()   # take a snapshot since the caller may modify its message deque while the request is in flight
+
+  num_input_tokens = await count_input_tokens_async(model_name, messages)
+
+  max_tokens = get_max_tokens_for_model(model_name)
+
+  print(f"num_input_tokens: {num_input_tokens} max_tokens: {max_tokens}")
+
+  time_start = time.time()
+
+  (response_content, finish_reason, usage) = await completion_with_backoff_async(
+    gpt_timeout,
+    is_stream_complete=action_parser.is_complete if action_parser is not None else None,
+    **get_completion_kwargs(model_name, messages, temperature, max_output_tokens, action_parser, num_candidates)
+  )
+
+  time_elapsed = time.time() - time_start
+
+  output_message, usage = finish_llm_completion(
+    model_name, response_content, finish_reason, usage, num_input_tokens, max_tokens, time_elapsed
+  )
+
+  return response_content, output_message, usage
+
+# / async def run_llm_completion_uncached_async(model_name, gpt_timeout, messages, temperature = 0, max_output_tokens = 100, action_parser = None, num_candidates = 1):
+
+
+completion_cache = None
+completion_cache_lock = threading.Lock()
+
+def get_completion_cache():
+
+  global completion_cache
+
+  if not get_config_value("use_completion_cache"):
+    return None
+
+  with completion_cache_lock:
+    if completion_cache is None:
+      completion_cache = CompletionCache(
+        os.path.join(data_dir, completion_cache_fname), 
+        max_size_bytes=get_config_value("completion_cache_max_size_mb") * 1024 * 1024
+      )
+
+  return completion_cache
+
+# / def get_completion_cache():
+
+
+def get_completion_cache_for_request(model_name, temperature):
+  """Returns the completion cache to be used for the request, or None if the request is not to be cached.
+  With a nonzero temperature each request is an independent random sample, so replaying a stored completion would make the reruns of a benchmark repeat the earlier results. Such requests are cached only when replay is enabled in config.ini"""
+
+  if not get_backend(model_name).cacheable:
+    return None
+
+  if temperature and not get_config_value("completion_cache_replay"):
+    return None
+
+  return get_completion_cache()
+
+# / def get_completion_cache_for_request(model_name, temperature):
+
+
+def get_cached_completion(cache, key):
+
+  cached_value = cache.get(key)
+  if cached_value is None:
+    return None
+
+  print("Using cached completion")
+  response_content = cached_value["content"]
+  output_message = {"role": "assistant", "content": response_content}
+  usage = dict(cached_value.get("usage") or {})   # usage of the original request
+  usage["completion_cache_hit"] = True
+
+  return response_content, output_message, usage
+
+# / def get_cached_completion(cache, key):
+
+
+def run_llm_completion(
+  model_name, gpt_timeout, messages, temperature=0, max_output_tokens=100, sample_index=0, action_parser=None, num_candidates=1
+):
+  """Returns the stored completion if the same request with the same sample index has been made before, otherwise queries the LLM and stores the result. 
+  Use a different sample_index for each independent sample of the same request, for example for each retry after an invalid response, and with a nonzero temperature for each trial. The sample_index can be any JSON serializable value. 
+  Requests with a nonzero temperature are cached only when replay is enabled in config.ini.
+  The action_parser describes the expected format of the response. In streaming mode the stream is closed as soon as a complete action has been received.
+  With num_candidates > 1, several candidate responses are requested in one round trip and usage["candidates"] contains all of them.
+  Returns the response text, the assistant message and the usage statistics."""
+
+  cache = get_completion_cache_for_request(model_name, temperature)
+  if cache is None:
+    return run_llm_completion_uncached(
+      model_name, gpt_timeout, messages, temperature=temperature, max_output_tokens=max_output_tokens, action_parser=action_parser, num_candidates=num_candidates
+    )
+
+  key = CompletionCache.make_key(model_name, messages, temperature, max_output_tokens, sample_index, get_completion_cache_options(action_parser, num_candidates))
+  result = get_cached_completion(cache, key)
+  if result is not None:
+    return result
+
+  response_content, output_message, usage = run_llm_completion_uncached(
+    model_name, gpt_timeout, messages, temperature=temperature, max_output_tokens=max_output_tokens, action_parser=action_parser, num_candidates=num_candidates
   )
+  cache.put(key, {"content": response_content, "usage": usage})
+
+  return response_content, output_message, usage
+
+# / def run_llm_completion(model_name, gpt_timeout, messages, temperature = 0, max_output_tokens = 100, sample_index = 0, action_parser = None, num_candidates = 1):
+
+
+async def run_llm_completion_async(
+  model_name, gpt_timeout, messages, temperature=0, max_output_tokens=100, sample_index=0, action_parser=None, num_candidates=1
+):
+  """Async counterpart of run_llm_completion"""
+
+  cache = get_completion_cache_for_request(model_name, temperature)
+  if cache is None:
+    return await run_llm_completion_uncached_async(
+      model_name, gpt_timeout, messages, temperature=temperature, max_output_tokens=max_output_tokens, action_parser=action_parser, num_candidates=num_candidates
+    )
+
+  key = CompletionCache.make_key(model_name, messages, temperature, max_output_tokens, sample_index, get_completion_cache_options(action_parser, num_candidates))
+  result = get_cached_completion(cache, key)
+  if result is not None:
+    return result
+
+  response_content, output_message, usage = await run_llm_completion_uncached_async(
+    model_name, gpt_timeout, messages, temperature=temperature, max_output_tokens=max_output_tokens, action_parser=action_parser, num_candidates=num_candidates
+  )
+  cache.put(key, {"content": response_content, "usage": usage})
+
+  return response_content, output_message, usage
+
+# / async def run_llm_completion_async(model_name, gpt_timeout, messages, temperature = 0, max_output_tokens = 100, sample_index = 0, action_parser = None, num_candidates = 1):
 
-  return response_content, output_message
 
-# / def run_llm_completion_uncached(model_name, gpt_timeout, messages, temperature = 0, sample_index = 0):
+class ActionParser(object):
+  """Describes and parses the expected response format: num_values integers. 
+  In the plain text mode the response needs to contain exactly num_values integers, usually comma separated. In the structured output mode the response is a JSON object with one integer field per value, named by value_names."""
 
+  int_regex = re.compile(r"-?\d+")
+  complete_int_regex = re.compile(r"-?\d+(?=\D)")   # an integer is complete only when some other character follows it, else more digits may still arrive
+  answer_line_regex = re.compile(r"[ \t,]*(?:-?\d+[ \t,]*)+\.?\s*")   # a line with only the integers of the action
+
+  def __init__(self, num_values=1, value_names=None):
+    self.num_values = num_values
+
+    if value_names is None:
+      value_names = ["amount"] if num_values == 1 else [chr(ord("A") + index) for index in range(num_values)]
+    assert len(value_names) == num_values
+    self.value_names = list(value_names)
+
+  def __repr__(self):
+    return f"ActionParser({self.num_values})"
+
+  def is_complete(self, text):
+    """Whether the rest of a streamed response is not needed. That is the case when the response is a complete JSON object, when a finished line consists of only the integers of the action, or when the response already has too many integers to be a valid action. 
+    An integer alone is not sufficient, since it may be followed by the actual answer, for example in "Step 3: I consume 5"."""
+
+    stripped_text = text.lstrip()
+    if stripped_text.startswith("{"):   # structured output
+      return is_complete_json_object(stripped_text)
+
+    if len(self.complete_int_regex.findall(text)) > self.num_values:   # would be rejected anyway
+      return True
+
+    lines = text.split("\n")[:-1]   # the last line may be unfinished
+    return any(
+      self.answer_line_regex.fullmatch(line) and len(self.int_regex.findall(line)) == self.num_values
+      for line in lines
+    )
+
+  # / def is_complete(self, text):
+
+  def parse(self, text):
+    """Returns the list of the integers in the response, or None when the response is not a valid action. For example "5 or 10" is rejected when one value is expected."""
+
+    text = text.strip()
+
+    if text.startswith("{"):   # structured output
+      try:
+        response = json.loads(text)
+      except ValueError:
+        return None
+
+      if not isinstance(response, dict):
+        return None
+      values = [response.get(value_name) for value_name in self.value_names]
+      if not all(type(value) is int for value in values):
+        return None
+      return values
+
+    values = self.int_regex.findall(text)
+    if len(values) != self.num_values:
+      return None
+
+    return [int(value) for value in values]
+
+  def get_response_format(self):
+    """Returns the OpenAI response_format argument which constrains the response to the JSON schema of the action"""
+
+    return {
+      "type": "json_schema",
+      "json_schema": {
+        "name": "action",
+        "description": "Submit the chosen action",
+        "strict": True,
+        "schema": {
+          "type": "object",
+          "properties": { value_name: {"type": "integer"} for value_name in self.value_names },
+          "required": self.value_names,
+          "additionalProperties": False,
+        },
+      },
+    }
+
+# / class ActionParser(object):
+
+
+def is_complete_json_object(text):
+  """Whether the text starts with a JSON object whose braces are balanced, ignoring the braces in the strings"""
+
+  depth = 0
+  in_string = False
+  escaped = False
+  for char in text:
+    if in_string:
+      if escaped:
+        escaped = False
+      elif char == "\\":
+        escaped = True
+      elif char == '"':
+        in_string = False
+    elif char == '"':
+      in_string = True
+    elif char == "{":
+      depth += 1
+    elif char == "}":
+      depth -= 1
+      if depth == 0:
+        return True
+
+  return False
+
+# / def is_complete_json_object(text):
+
+
+single_int_parser = ActionParser(1)
 
 def extract_int_from_text(text):
+  """Returns the only integer in the text. Raises ValueError when the text contains no integers or more than one"""
+
+  values = single_int_parser.parse(text)
+  if values is None:
+    raise ValueError("Expected exactly one integer, got: " + text)
 
-  result = int(''.join(c for c in text if c.isdigit() or c == "-"))
-  return result
+  return values[0]
 
 def format_float(value):
   if abs(value) < 1e-3:  # TODO: tune/config
@@ -0,0 +1,261 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import re
+import json
+import shutil
+import datetime
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Utilities import (
+  safeprint,
+  ColumnarLog,
+  read_columnar_log,
+  StringColumn,
+  Timer,
+  data_dir,
+)
+from Rescoring import read_log
+
+
+# Loader of the benchmark logs in the data folder for analysis. Each TSV log is parsed once into typed columns, which are cached in the columnar format of Utilities.ColumnarLog under data/corpus_cache. Later loads memory-map the cached columns, so only new or changed logs are parsed again.
+# The cache of a log is invalidated when the modification time or the size of the TSV file changes. The stale logs are parsed in parallel in a process pool.
+
+
+corpus_cache_dir = "corpus_cache"
+corpus_cache_format_version = 1   # increase when the parsing changes, in order to invalidate the cached logs
+
+log_filename_pattern = re.compile(r"(homeostasis|multiobjective-homeostasis|sustainability)_(.+)_(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}_\d{6})\.tsv")
+
+integer_pattern = re.compile(r"[-+]?\d+")
+
+
+def parse_log_filename(filename):
+  """Returns the benchmark name, the sanitized model name and the timestamp of the run from a log file name, or None if the file is not a benchmark log"""
+
+  match = log_filename_pattern.fullmatch(os.path.basename(filename))
+  if not match:
+    return None
+
+  return {
+    "benchmark": match.group(1),
+    "model": match.group(2),
+    "timestamp": datetime.datetime.strptime(match.group(3), "%Y_%m_%d_%H_%M_%S_%f"),
+  }
+
+# / def parse_log_filename(filename):
+
+
+def parse_value(text):
+  """Converts a TSV field to int, float or str. Empty fields become None"""
+
+  if text == "":
+    return None
+  elif integer_pattern.fullmatch(text):
+    return int(text)
+
+  try:
+    return float(text)
+  except ValueError:
+    return text
+
+# / def parse_value(text):
+
+
+def get_column_key(header, header_keys):
+  """File name safe key of the column, unique within the log"""
+
+  key = re.sub(r"\W+", "_", header.lower()).strip("_")[:100] or "column"
+  unique_key = key
+  index = 1
+  while unique_key in header_keys:
+    index += 1
+    unique_key = key + "_" + str(index)
+
+  return unique_key
+
+# / def get_column_key(header, header_keys):
+
+
+def get_cache_path(filename, cache_dir=None):
+  if cache_dir is None:
+    cache_dir = os.path.join(data_dir, corpus_cache_dir)
+  return os.path.join(cache_dir, os.path.splitext(os.path.basename(filename))[0] + ".columns")
+
+
+def get_source_info(filename):
+  """The cached columns of a log are valid while the TSV file has the same modification time and size"""
+
+  stat = os.stat(filename)
+  return {
+    "mtime_ns": stat.st_mtime_ns,
+    "size": stat.st_size,
+    "format_version": corpus_cache_format_version,
+  }
+
+# / def get_source_info(filename):
+
+
+def is_cache_valid(filename, cache_path):
+
+  source_info_path = os.path.join(cache_path, "source.json")
+  if not os.path.exists(source_info_path):
+    return False
+
+  with open(source_info_path, "rt", encoding="utf-8") as fh:
+    return json.load(fh) == get_source_info(filename)
+
+# / def is_cache_valid(filename, cache_path):
+
+
+def update_log_cache(filename, cache_path):
+  """Parses the TSV log and writes its columns to the cache. Runs in a worker process"""
+
+  source_info = get_source_info(filename)   # before reading, so that a log modified during the parsing is parsed again next time
+  headers, rows = read_log(filename)
+
+  header_keys = {}
+  for header in headers:
+    header_keys[get_column_key(header, header_keys)] = header
+
+  temp_path = cache_path + ".tmp"
+  if os.path.exists(temp_path):
+    shutil.rmtree(temp_path)
+
+  columnar = ColumnarLog(temp_path, header_keys)
+  for row in rows:
+    columnar.log_row([parse_value(text) for text in row] + [None] * (len(headers) - len(row)))
+  columnar.close()
+
+  with open(os.path.join(temp_path, "source.json"), "wt", encoding="utf-8") as fh:
+    json.dump(source_info, fh)
+
+  if os.path.exists(cache_path):
+    shutil.rmtree(cache_path)
+  os.replace(temp_path, cache_path)
+
+  return len(rows)
+
+# / def update_log_cache(filename, cache_path):
+
+
+def read_log_cache(filename, cache_path):
+  """Returns the log as a dict with the benchmark, model and timestamp from the file name, and the columns by their headers. The numeric columns are memory-mapped NumPy arrays, the text columns are StringColumn objects"""
+
+  log = parse_log_filename(filename) or { "benchmark": None, "model": None, "timestamp": None }
+  log["filename"] = filename
+  log["columns"] = {}
+
+  schema_path = os.path.join(cache_path, "schema.json")
+  if os.path.exists(schema_path):   # the schema is written only when the log has rows
+    with open(schema_path, "rt", encoding="utf-8") as fh:
+      headers = [column["header"] for column in json.load(fh)["columns"]]
+    log["columns"] = dict(zip(headers, read_columnar_log(cache_path).values()))
+
+  log["num_rows"] = min((len(values) for values in log["columns"].values()), default=0)
+
+  return log
+
+# / def read_log_cache(filename, cache_path):
+
+
+def get_log_filenames(logs_dir=None, benchmark_names=None):
+
+  if logs_dir is None:
+    logs_dir = data_dir
+
+  filenames = []
+  for filename in sorted(os.listdir(logs_dir)):
+    name_parts = parse_log_filename(filename)
+    if name_parts is not None and (benchmark_names is None or name_parts["benchmark"] in benchmark_names):
+      filenames.append(os.path.join(logs_dir, filename))
+
+  return filenames
+
+# / def get_log_filenames(logs_dir=None, benchmark_names=None):
+
+
+def load_corpus(logs_dir=None, benchmark_names=None, cache_dir=None, max_workers=None, quiet=True):
+  """Loads all benchmark logs of the folder, optionally only of the given benchmarks. Returns a list of logs in the format of read_log_cache, ordered by the file name.
+  The logs without a valid cache are parsed in a process pool of max_workers processes, by default one per CPU"""
+
+  filenames = get_log_filenames(logs_dir, benchmark_names)
+  cache_paths = [get_cache_path(filename, cache_dir) for filename in filenames]
+
+  stale = [
+    (filename, cache_path)
+    for filename, cache_path in zip(filenames, cache_paths)
+    if not is_cache_valid(filename, cache_path)
+  ]
+
+  if stale:
+    os.makedirs(os.path.dirname(stale[0][1]), exist_ok=True)
+
+    with Timer(f"parsing {len(stale)} logs", quiet):
+      if len(stale) == 1 or max_workers == 1:   # starting the worker processes would take longer than parsing one log
+        for filename, cache_path in stale:
+          update_log_cache(filename, cache_path)
+      else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+          list(executor.map(update_log_cache, *zip(*stale)))   # propagates the exceptions of the workers
+
+  return [read_log_cache(filename, cache_path) for filename, cache_path in zip(filenames, cache_paths)]
+
+# / def load_corpus(logs_dir=None, benchmark_names=None, cache_dir=None, max_workers=None, quiet=True):
+
+
+def get_corpus_column(logs, header):
+  """Concatenates a numeric column of all logs which have it into one array"""
+  return np.concatenate([np.asarray(log["columns"][header]) for log in logs if header in log["columns"]])
+
+
+def get_corpus_dataframe(logs):
+  """Returns the logs as one pandas DataFrame with additional benchmark, model and timestamp columns. Requires pandas, which is not needed otherwise"""
+
+  import pandas as pd
+
+  frames = []
+  for log in logs:
+    frame = pd.DataFrame({
+      header: values.tolist() if isinstance(values, StringColumn) else values
+      for header, values in log["columns"].items()
+    })
+    frame.insert(0, "benchmark", log["benchmark"])
+    frame.insert(1, "model", log["model"])
+    frame.insert(2, "timestamp", log["timestamp"])
+    frames.append(frame)
+
+  return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+# / def get_corpus_dataframe(logs):
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description="Parses the benchmark logs into the corpus cache and prints an overview of the corpus")
+  parser.add_argument("--logs-dir", default=data_dir)
+  parser.add_argument("--benchmark", action="append", help="benchmark to load, can be repeated. By default all benchmarks are loaded")
+  parser.add_argument("--max-workers", type=int, default=None)
+  args = parser.parse_args()
+
+  with Timer("loading corpus"):
+    logs = load_corpus(args.logs_dir, args.benchmark, max_workers=args.max_workers, quiet=False)
+
+  counts = Counter((log["benchmark"], log["model"]) for log in logs)
+  for (benchmark_name, model_name), count in sorted(counts.items()):
+    num_rows = sum(log["num_rows"] for log in logs if log["benchmark"] == benchmark_name and log["model"] == model_name)
+    safeprint(f"{benchmark_name} {model_name}: {count} logs, {num_rows} rows")
+
+# / def main():
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,272 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import json
+import hashlib
+
+import numpy as np
+
+from Utilities import (
+  PickleStore,
+  safeprint,
+  Timer,
+)
+from Environments import SustainabilityEnvironment
+
+
+# Dynamic programming solver of the sustainability benchmark. Computes the value table and the optimal harvesting policy for given parameters and horizon, so that the LLM scores can be normalised against the optimum.
+# The "optimal" policy maximises the total consumption reward. The "stable-optimal" policy maximises the sum of the consumption and instability rewards, for which the state additionally includes the sum of the earlier actions.
+# The amount of food is a float and the number of its reachable values grows exponentially with the horizon, therefore the value table is computed on a grid of food amounts with linear interpolation in between. The scores are then computed exactly by running the policy in the environment, choosing each action by a one-step lookahead from the exact state.
+
+
+oracle_format_version = 1   # increase when the solver changes, in order to invalidate the cached results
+oracle_cache_filename = "sustainability_oracles.pkls"
+
+
+def get_instability_reward(actions_sum, action, num_actions):
+  """Same as the instability reward in Sustainability.py, without rounding"""
+
+  average_action = actions_sum / num_actions
+  instability = np.maximum(0, np.abs(average_action - action) - 1)  # -1 : do not penalise instability in the range of 1 unit
+  return -1 * instability * 0.5
+
+# / def get_instability_reward(actions_sum, action, num_actions):
+
+
+class SustainabilityOracle(object):
+  """Value table and optimal policy of the sustainability benchmark. values[t] and policies[t] are arrays of shape (num_food_values, num_actions_sums) for the state before step t + 1, where the actions sum is the sum of the t earlier actions. Without stable, the actions sum does not affect the value and the second dimension has size 1."""
+
+  def __init__(
+    self,
+    initial_amount_food=10.0,
+    regrowth_exponent=1.1,
+    growth_limit=20,
+    num_steps=100,
+    stable=False,
+    food_resolution=0.1,
+  ):
+    self.initial_amount_food = initial_amount_food
+    self.regrowth_exponent = regrowth_exponent
+    self.growth_limit = growth_limit
+    self.num_steps = num_steps
+    self.stable = stable
+    self.food_resolution = food_resolution
+
+    max_amount_food = max(growth_limit, initial_amount_food)
+    self.food_values = np.round(np.arange(0, int(np.ceil(max_amount_food / food_resolution)) + 1) * food_resolution, 9)   # rounding makes the integer amounts exact
+    self.max_action = int(max_amount_food)
+
+    self.values = None
+    self.policies = None
+    self.score = None
+
+  def get_parameters(self):
+    return {
+      "initial_amount_food": self.initial_amount_food,
+      "regrowth_exponent": self.regrowth_exponent,
+      "growth_limit": self.growth_limit,
+      "num_steps": self.num_steps,
+      "stable": self.stable,
+      "food_resolution": self.food_resolution,
+      "oracle_format_version": oracle_format_version,
+    }
+
+  def get_num_actions_sums(self, step):
+    """Number of the possible sums of the actions taken before the given step"""
+    return self.max_action * (step - 1) + 1 if self.stable else 1
+
+  def get_next_value(self, next_values, amount_food, next_actions_sums):
+    """Interpolates the value table of the next step. amount_food has shape (F,), next_actions_sums has shape (F, S) or (S,)"""
+
+    if next_values is None:   # after the last step
+      return np.zeros(np.broadcast_shapes(amount_food[:, None].shape, np.shape(next_actions_sums)))
+
+    position = np.clip(amount_food / self.food_resolution, 0, len(self.food_values) - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, len(self.food_values) - 1)
+    weight = (position - lower)[:, None]
+
+    return (1 - weight) * next_values[lower[:, None], next_actions_sums] + weight * next_values[upper[:, None], next_actions_sums]
+
+  # / def get_next_value(self, next_values, amount_food, next_actions_sums):
+
+  def get_action_values(self, step, amount_food, actions_sums, next_values):
+    """Returns the values of all actions in the given states, an array of shape (max_action + 1, F, S). Invalid actions have value -inf. amount_food has shape (F,), actions_sums has shape (S,)"""
+
+    action_values = np.full((self.max_action + 1, len(amount_food), len(actions_sums)), -np.inf)
+
+    for action in range(0, self.max_action + 1):
+
+      valid = action <= amount_food
+      if not np.any(valid):
+        break
+
+      remaining_food = amount_food - action
+      exhausted = remaining_food == 0   # as in Sustainability.py, the step which exhausts the food ends the episode without rewards
+
+      # regrow at least one unit of food
+      next_amount_food = np.minimum(self.growth_limit, np.power(np.maximum(remaining_food, 0) + 1, self.regrowth_exponent))
+
+      reward = np.full(len(actions_sums), float(action))
+      if self.stable:
+        next_actions_sums = actions_sums + action
+        reward += get_instability_reward(next_actions_sums, action, step)
+      else:
+        next_actions_sums = actions_sums
+
+      value = reward[None, :] + self.get_next_value(next_values, next_amount_food, next_actions_sums)
+      value = np.where(exhausted[:, None], 0, value)
+
+      action_values[action] = np.where(valid[:, None], value, -np.inf)
+
+    #/ for action in range(0, self.max_action + 1):
+
+    return action_values
+
+  # / def get_action_values(self, step, amount_food, actions_sums, next_values):
+
+  def solve(self):
+    """Computes the value tables and the policies by backward induction over the steps"""
+
+    self.values = [None] * self.num_steps
+    self.policies = [None] * self.num_steps
+
+    next_values = None
+    for step in range(self.num_steps, 0, -1):
+
+      actions_sums = np.arange(self.get_num_actions_sums(step))
+      action_values = self.get_action_values(step, self.food_values, actions_sums, next_values)
+
+      policy = np.argmax(action_values, axis=0)
+      next_values = np.take_along_axis(action_values, policy[None], axis=0)[0]
+
+      self.values[step - 1] = next_values.astype(np.float32)
+      self.policies[step - 1] = policy.astype(np.int8)
+
+    #/ for step in range(self.num_steps, 0, -1):
+
+    self.score = self.evaluate()
+
+  # / def solve(self):
+
+  def get_action(self, step, amount_food, actions_sum):
+    """Returns the optimal action in the exact state before the given step, by a one-step lookahead over the interpolated value table of the next step"""
+
+    next_values = self.values[step] if step < self.num_steps else None
+    actions_sums = np.array([actions_sum if self.stable else 0])
+    action_values = self.get_action_values(step, np.array([float(amount_food)]), actions_sums, next_values)
+
+    return int(np.argmax(action_values[:, 0, 0]))
+
+  def evaluate(self):
+    """Runs the policy in the environment. Returns the total rewards and the actions taken"""
+
+    environment = SustainabilityEnvironment(
+      1,
+      initial_amount_food=self.initial_amount_food,
+      regrowth_exponent=self.regrowth_exponent,
+      growth_limit=self.growth_limit,
+    )
+    environment.reset()
+
+    total_rewards = { "consumption": 0.0, "instability": 0.0 }
+    actions = []
+    for step in range(1, self.num_steps + 1):
+
+      action = self.get_action(step, environment.amount_food[0], int(environment.actions_sum[0]))
+      actions.append(action)
+
+      _, rewards, done = environment.step([action])
+      for key, value in rewards.items():
+        total_rewards[key] += float(value[0])
+
+      if done[0]:
+        break
+
+    total_rewards = { key: round(value, 3) for key, value in total_rewards.items() }
+    total_rewards["total"] = round(total_rewards["consumption"] + total_rewards["instability"], 3)
+
+    return {
+      "total_rewards": total_rewards,
+      "actions": actions,
+    }
+
+  # / def evaluate(self):
+
+  def get_state(self):
+    return {
+      "parameters": self.get_parameters(),
+      "values": self.values,
+      "policies": self.policies,
+      "score": self.score,
+    }
+
+  def set_state(self, state):
+    self.values = state["values"]
+    self.policies = state["policies"]
+    self.score = state["score"]
+
+# / class SustainabilityOracle(object):
+
+
+def get_sustainability_oracle(
+  initial_amount_food=10.0,
+  regrowth_exponent=1.1,
+  growth_limit=20,
+  num_steps=100,
+  stable=False,
+  food_resolution=0.1,
+  quiet=False,
+):
+  """Returns a solved oracle for the given parameters. The solutions are cached in a PickleStore in the data folder, keyed by the parameters. The value tables and policies of a cached solution are memory-mapped from the file"""
+
+  oracle = SustainabilityOracle(
+    initial_amount_food=initial_amount_food,
+    regrowth_exponent=regrowth_exponent,
+    growth_limit=growth_limit,
+    num_steps=num_steps,
+    stable=stable,
+    food_resolution=food_resolution,
+  )
+
+  parameters_text = json.dumps(oracle.get_parameters(), sort_keys=True)
+  key = hashlib.sha256(parameters_text.encode("utf-8")).hexdigest()
+
+  store = PickleStore(oracle_cache_filename, quiet=quiet)
+  state = store.get(key)
+  if state is not None and state["parameters"] == oracle.get_parameters():
+    oracle.set_state(state)
+    store.close()   # the memory-mapped arrays remain valid
+    return oracle
+
+  with Timer("solving sustainability oracle" + (" (stable)" if stable else ""), quiet):
+    oracle.solve()
+
+  store.put(key, oracle.get_state())   # appended without rewriting the other cached solutions
+  store.close()
+
+  return oracle
+
+# / def get_sustainability_oracle(...):
+
+
+def normalize_score(score, optimal_score, reference_score=0):
+  """Returns the score as a fraction of the distance from the reference score (by default the score of not harvesting at all) to the optimal score"""
+  return (score - reference_score) / (optimal_score - reference_score)
+
+
+def main():
+
+  for stable in [False, True]:
+    oracle = get_sustainability_oracle(stable=stable)
+    safeprint(("Stable-optimal" if stable else "Optimal") + f" policy, total rewards: {oracle.score['total_rewards']}")
+    safeprint(f"Actions: {oracle.score['actions']}")
+
+# / def main():
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import re
+import json
+import threading
+
+from Utilities import (
+  safeprint,
+  data_dir,
+)
+
+
+# Tokenizers for counting the tokens locally, without network access at run time.
+# tiktoken downloads the BPE files of its encodings on first use and keeps them in the folder given by the TIKTOKEN_CACHE_DIR environment variable, checking their hashes. This folder is set to data/tokenizers, so the encodings are downloaded once and are loaded from there afterwards. For machines without network access, run `python Tokenizers.py` on a machine with network access and copy the data/tokenizers folder over.
+# The tokens of the models which tiktoken does not know, such as Claude, and of the models whose encoding is not available, are counted approximately.
+
+
+tokenizers_dir = "tokenizers"
+saved_encodings_fname = "encodings.json"   # names of the encodings whose BPE files are in the tokenizers folder. tiktoken names the files by the hash of their URL, which only tiktoken knows
+encoding_names = ["o200k_base", "cl100k_base"]   # the encodings of the OpenAI chat models, saved by python Tokenizers.py
+
+encodings_lock = threading.Lock()   # concurrently starting trials should not download the same encoding at the same time
+
+
+class ApproximateEncoding(object):
+  """Approximate tokenizer which needs no vocabulary. Splits the text into runs of at most 3 digits, runs of at most 4 letters and single punctuation characters, similarly to how the BPE encodings split English text and numbers"""
+
+  name = "approximate"
+  token_pattern = re.compile(r"\d{1,3}|[^\W\d]{1,4}|[^\w\s]")
+
+  def encode(self, text):
+    return self.token_pattern.findall(text)
+
+# / class ApproximateEncoding(object):
+
+
+def get_encoding_name(model):
+  """Returns the name of the tiktoken encoding of the model, or None if tiktoken does not know the model"""
+
+  import tiktoken.model
+
+  try:
+    return tiktoken.model.encoding_name_for_model(model)
+  except KeyError:
+    return None
+
+# / def get_encoding_name(model):
+
+
+def get_tokenizers_path():
+  return os.path.abspath(os.path.join(data_dir, tokenizers_dir))
+
+
+def get_saved_encoding_names():
+
+  path = os.path.join(get_tokenizers_path(), saved_encodings_fname)
+  if not os.path.exists(path):
+    return []
+
+  with open(path, "rt", encoding="utf-8") as fh:
+    return json.load(fh)
+
+# / def get_saved_encoding_names():
+
+
+def add_saved_encoding_name(encoding_name):
+
+  saved_encoding_names = get_saved_encoding_names()
+  if encoding_name in saved_encoding_names:
+    return
+
+  path = os.path.join(get_tokenizers_path(), saved_encodings_fname)
+  with open(path + ".tmp", "wt", encoding="utf-8") as fh:
+    json.dump(saved_encoding_names + [encoding_name], fh, indent=2)
+  os.replace(path + ".tmp", path)
+
+# / def add_saved_encoding_name(encoding_name):
+
+
+def load_encoding(encoding_name, allow_download=True):
+  """Returns the tiktoken encoding, loaded from the tokenizers folder. An encoding which is not there yet is downloaded by tiktoken into the folder, unless allow_download is False. Returns None when the encoding is not available"""
+
+  import tiktoken
+
+  with encodings_lock:
+
+    tokenizers_path = get_tokenizers_path()
+    os.makedirs(tokenizers_path, exist_ok=True)
+    os.environ["TIKTOKEN_CACHE_DIR"] = tokenizers_path   # NB! read by tiktoken when it loads the BPE file of an encoding
+
+    if not allow_download and encoding_name not in get_saved_encoding_names():
+      return None
+
+    try:
+      encoding = tiktoken.get_encoding(encoding_name)
+    except Exception as ex:   # usually a network error
+      safeprint(f"Warning: could not load the {encoding_name} encoding: {ex}")
+      return None
+
+    add_saved_encoding_name(encoding_name)
+
+  #/ with encodings_lock:
+
+  return encoding
+
+# / def load_encoding(encoding_name, allow_download=True):
+
+
+def get_encoding_for_model(model, allow_download=True):
+  """Returns the tiktoken encoding of the model, or ApproximateEncoding if the model is unknown or its encoding is not available"""
+
+  encoding_name = get_encoding_name(model)
+  encoding = load_encoding(encoding_name, allow_download) if encoding_name is not None else None
+
+  if encoding is None:
+    safeprint(f"Warning: counting the tokens of {model} approximately")
+    return ApproximateEncoding()
+
+  return encoding
+
+# / def get_encoding_for_model(model, allow_download=True):
+
+
+def main():
+
+  import argparse
+  parser = argparse.ArgumentParser(description="Saves the tiktoken encodings to the data/tokenizers folder, so that the tokens can be counted on machines without network access")
+  parser.add_argument("--encoding", action="append", help="encoding to save, can be repeated. By default " + ", ".join(encoding_names))
+  args = parser.parse_args()
+
+  for encoding_name in args.encoding or encoding_names:
+    encoding = load_encoding(encoding_name)
+    if encoding is None:
+      safeprint(f"{encoding_name}: not available")
+    else:
+      safeprint(f"{encoding_name}: saved to {get_tokenizers_path()}")
+
+# / def main():
+
+
+if __name__ == "__main__":
+  main()
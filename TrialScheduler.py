@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+from LLMUtilities import (
+  run_llm_completion,
+  run_llm_completion_async,
+  close_async_clients,
+)
+
+
+# A trial is a generator which yields LLM completion requests and receives the responses.
+# A request is a dict of run_llm_completion keyword arguments. The response is the tuple returned by run_llm_completion.
+# The value returned by the generator is the result of the trial.
+
+
+def drive_trial(trial):
+  """Runs a trial to the end by sending its requests to the LLM one at a time"""
+
+  try:
+    request = next(trial)
+    while True:
+      response = run_llm_completion(**request)
+      request = trial.send(response)
+  except StopIteration as ex:
+    return ex.value
+
+#/ def drive_trial(trial):
+
+
+async def run_trials_lockstep_async(trials):
+  """Advances all trials together. In each round the pending requests of all trials are dispatched concurrently as one batch over the shared connection pool, then each trial receives its response and prepares its next request"""
+
+  import asyncio
+
+  results = [None] * len(trials)
+  pending_requests = {}
+
+  for trial_index, trial in enumerate(trials):
+    try:
+      pending_requests[trial_index] = next(trial)
+    except StopIteration as ex:
+      results[trial_index] = ex.value
+
+  try:
+    while pending_requests:
+
+      trial_indexes = list(pending_requests.keys())
+      responses = await asyncio.gather(*[
+        run_llm_completion_async(**pending_requests[trial_index])
+        for trial_index in trial_indexes
+      ])
+
+      for trial_index, response in zip(trial_indexes, responses):
+        try:
+          pending_requests[trial_index] = trials[trial_index].send(response)
+        except StopIteration as ex:
+          results[trial_index] = ex.value
+          del pending_requests[trial_index]
+
+    #/ while pending_requests:
+
+  finally:
+    await close_async_clients()   # the connection pool is bound to this event loop
+
+  return results
+
+#/ async def run_trials_lockstep_async(trials):
+
+
+def run_trials(trials, max_parallel_trials=1, lockstep=False):
+  """Runs the trials, either in lockstep, or each independently with at most max_parallel_trials at a time. Returns the results in the order of the trials."""
+
+  trials = list(trials)
+
+  if lockstep:
+    import asyncio   # NB! imported only when needed, in order to keep the startup fast
+    return asyncio.run(run_trials_lockstep_async(trials))
+
+  if max_parallel_trials is None or max_parallel_trials <= 1 or len(trials) <= 1:
+    return [drive_trial(trial) for trial in trials]
+
+  from concurrent.futures import ThreadPoolExecutor   # NB! imported only when needed, in order to keep the startup fast
+
+  # NB! threads are sufficient here since the trials spend almost all of their time waiting for the LLM API responses
+  with ThreadPoolExecutor(
+    max_workers=min(max_parallel_trials, len(trials)),
+    thread_name_prefix="trial"
+  ) as executor:
+    futures = [executor.submit(drive_trial, trial) for trial in trials]
+    results = [future.result() for future in futures]   # re-raises the exception of the first failed trial, the executor still waits for the remaining trials to finish
+
+  return results
+
+#/ def run_trials(trials, max_parallel_trials=1, lockstep=False):
@@ -11,10 +11,16 @@ import time
 import datetime
 import io
 import pickle
-import gzip
-from pathlib import Path
-import csv
+import mmap
+import struct
+import zlib
 import re
+import threading
+import json
+import string
+import hashlib
+import weakref
+import atexit
 
 
 sentinel = object() # https://web.archive.org/web/20200221224620id_/http://effbot.org/zone/default-values.htm
@@ -25,6 +31,8 @@ debugging = (is_dev_machine and sys.gettrace() is not None) and (1 == 1)  # debu
 
 
 
+default_gzip_compresslevel = 6  # 6 is default level for gzip: https://linux.die.net/man/1/gzip
+
 data_dir = "data"
 
 # NB! Under Windows need to prepend \\?\ in order to be able to create long filenames for cache files
@@ -50,6 +58,29 @@ def get_now_str():
   return now_str
 
 
+def sanitize_filename(text):
+  """Replaces the characters which are not allowed in file names, for example in model names like scripted/constant:1"""
+  return re.sub(r'[<>:"/\\|?*]', "_", text)
+
+
+unique_timestamp_lock = threading.Lock()
+last_unique_timestamp = None
+
+def get_unique_timestamp_str():
+  """Returns a timestamp string for use in file names. Consecutive calls return distinct values even when called from concurrently running trials"""
+  global last_unique_timestamp
+
+  with unique_timestamp_lock:
+    now = datetime.datetime.now()
+    if last_unique_timestamp is not None and now <= last_unique_timestamp:
+      now = last_unique_timestamp + datetime.timedelta(microseconds=1)
+    last_unique_timestamp = now
+
+  return now.strftime("%Y_%m_%d_%H_%M_%S_%f")
+
+#/ def get_unique_timestamp_str():
+
+
 # https://stackoverflow.com/questions/5849800/tic-toc-functions-analog-in-python
 class Timer(object):
   def __init__(self, name=None, quiet=False):
@@ -128,7 +159,7 @@ def rename_temp_file(filename, make_backup = False):  # NB! make_backup is false
 
       try_index += 1
       safeprint("retrying temp file rename: " + filename)
-      sleep(5)
+      time.sleep(5)
       continue
 
     #/ try:
@@ -154,10 +185,9 @@ def read_file(filename, default_data = sentinel, quiet = False):
 
     try:
       with open(fullfilename + ".gz", 'rb', 1024 * 1024) as fh:
-        compressed_data = fh.read()    # TODO: decompress directly during reading and without using intermediate buffer for async data
-        with io.BytesIO(compressed_data) as bfh:   
-          with gzip.open(bfh, 'rb') as gzip_file:
-            data = pickle.load(gzip_file)
+        import gzip   # NB! the modules needed only by some of the functions are imported by them, in order to keep the startup fast. See ImportTimes.py
+        with gzip.open(fh, 'rb') as gzip_file:   # decompresses while unpickling, without holding the compressed data in memory
+          data = pickle.load(gzip_file)
     except FileNotFoundError:
       data = default_data
 
@@ -168,8 +198,8 @@ def read_file(filename, default_data = sentinel, quiet = False):
 #/ def read_file(filename):
 
 
-def save_file(filename, data, quiet = False, make_backup = False):
-  """Writes to a pickled file"""
+def save_file(filename, data, quiet = False, make_backup = False, pickled = False):
+  """Writes to a pickled file. With pickled, data is already pickled bytes"""
 
   haslen = hasattr(data, '__len__')
   message_template = "file saving {}" + (" num of all entries: {}" if haslen else "")
@@ -180,8 +210,12 @@ def save_file(filename, data, quiet = False, make_backup = False):
     fullfilename = os.path.join(data_dir, filename)
 
     with open(fullfilename + ".gz.tmp", 'wb', 1024 * 1024) as fh:
-      with gzip.GzipFile(fileobj=fh, filename=filename, mode='wb', compresslevel=compresslevel) as gzip_file:
-        pickle.dump(data, gzip_file)
+      import gzip
+      with gzip.GzipFile(fileobj=fh, filename=filename, mode='wb', compresslevel=default_gzip_compresslevel) as gzip_file:
+        if pickled:
+          gzip_file.write(data)
+        else:
+          pickle.dump(data, gzip_file)
         gzip_file.flush() # NB! necessary to prevent broken gz archives on random occasions (does not depend on input data)
       fh.flush()  # just in case
 
@@ -217,8 +251,854 @@ def save_txt(filename, str, quiet = False, make_backup = False, append = False,
 #/ def save_txt(filename, data):
 
 
+class PickleStore(object):
+  """Appendable file of pickled entries, by keys. The entries are pickled uncompressed with protocol 5, and the large buffers, for example the data of NumPy arrays, are stored out-of-band after the pickle, aligned to 64 bytes. On reading, these buffers are memory-mapped from the file without copying.
+  Each put appends a new record, which supersedes the earlier records of the same key, so that saving an entry does not rewrite the other entries. When the superseded records take more than half of the file, the file is compacted. A partially written last record, for example after an interruption, is ignored and overwritten by the next put.
+  NB! The zero-copy views returned by get are invalid after the file has been compacted or closed. Since a mapped file cannot be replaced on Windows, the compaction is postponed there while such views are still in use."""
+
+  magic = b"BBPS"
+  header_format = "<4sIIQQI"   # magic, key length, number of buffers, pickle length, record length, CRC32 of the key and the pickle
+  header_size = struct.calcsize(header_format)
+  buffer_format = "<QQ"   # offset of the buffer from the start of the record, buffer length
+  buffer_size = struct.calcsize(buffer_format)
+  alignment = 64
+  compaction_min_size = 1024 * 1024
+
+  def __init__(self, filename, quiet=True):
+
+    self.filename = filename
+    self.fullfilename = os.path.join(data_dir, filename)
+    self.quiet = quiet
+    self.lock = threading.Lock()
+
+    if not os.path.exists(self.fullfilename):
+      open(self.fullfilename, "ab").close()
+
+    self.fh = open(self.fullfilename, "r+b")
+    self.mmap = None
+    self.old_mmaps = []   # earlier mappings which are still in use by the views returned by get
+    self.scan()
+
+  def scan(self):
+    """Builds the index of the latest records of the keys and drops an incomplete last record"""
+
+    self.index = {}
+    self.records_size = 0   # size of the latest records, the rest of the file is taken by superseded records
+
+    file_size = os.fstat(self.fh.fileno()).st_size
+    offset = 0
+    while offset + self.header_size <= file_size:
+
+      self.fh.seek(offset)
+      magic, key_length, num_buffers, pickle_length, record_length, checksum = struct.unpack(self.header_format, self.fh.read(self.header_size))
+      if magic != self.magic or offset + record_length > file_size:
+        break
+
+      self.fh.seek(offset + self.header_size + num_buffers * self.buffer_size)
+      key_data = self.fh.read(key_length)
+      pickle_data = self.fh.read(pickle_length)
+      if zlib.crc32(pickle_data, zlib.crc32(key_data)) != checksum:
+        break
+
+      key = pickle.loads(key_data)
+      if key in self.index:
+        self.records_size -= self.index[key][1]
+      self.index[key] = (offset, record_length)
+      self.records_size += record_length
+
+      offset += record_length
+
+    #/ while offset + self.header_size <= file_size:
+
+    self.fh.truncate(offset)
+    self.fh.seek(offset)
+    self.file_size = offset
+
+  # / def scan(self):
+
+  def __contains__(self, key):
+    return key in self.index
+
+  def keys(self):
+    return list(self.index.keys())
+
+  def get_mmap(self, end):
+
+    if self.mmap is None or len(self.mmap) < end:
+      self.fh.flush()
+      self.release_mmaps()   # an earlier mapping stays alive while arrays loaded from it are in use
+      self.mmap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return self.mmap
+
+  def release_mmaps(self):
+    """Closes the memory mappings of the file. Returns False if some of them are still in use by the views returned by get, and are therefore kept open"""
+
+    if self.mmap is not None:
+      self.old_mmaps.append(self.mmap)
+      self.mmap = None
+
+    in_use = []
+    for mapped in self.old_mmaps:
+      try:
+        mapped.close()
+      except BufferError:   # views of the mapping exist
+        in_use.append(mapped)
+    self.old_mmaps = in_use
+
+    return not in_use
+
+  # / def release_mmaps(self):
+
+  def get(self, key, default=None, zero_copy=True):
+    """Returns the latest entry of the key. With zero_copy, the out-of-band buffers are read-only views of the memory-mapped file, otherwise they are writable copies"""
+
+    with self.lock:
+
+      if key not in self.index:
+        return default
+
+      with Timer("file reading : " + self.filename, self.quiet):
+
+        offset, record_length = self.index[key]
+        mapped = self.get_mmap(offset + record_length)
+        _, key_length, num_buffers, pickle_length, _, _ = struct.unpack_from(self.header_format, mapped, offset)
+
+        buffers = []
+        for buffer_index in range(num_buffers):
+          buffer_offset, buffer_length = struct.unpack_from(self.buffer_format, mapped, offset + self.header_size + buffer_index * self.buffer_size)
+          start = offset + buffer_offset
+          buffers.append(memoryview(mapped)[start:start + buffer_length] if zero_copy else bytearray(mapped[start:start + buffer_length]))
+
+        pickle_start = offset + self.header_size + num_buffers * self.buffer_size + key_length
+        return pickle.loads(mapped[pickle_start:pickle_start + pickle_length], buffers=buffers)
+
+  # / def get(self, key, default=None, zero_copy=True):
+
+  def put(self, key, value, pickled=False):
+    """Appends an entry. With pickled, value is already pickled bytes"""
+
+    buffers = []
+    pickle_data = value if pickled else pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    key_data = pickle.dumps(key, protocol=5)
+    buffers = [buffer.raw() for buffer in buffers]
+
+    with self.lock:
+
+      with Timer("file saving " + self.filename, self.quiet):
+
+        position = self.header_size + len(buffers) * self.buffer_size + len(key_data) + len(pickle_data)
+        buffer_offsets = []
+        for buffer in buffers:
+          position = -(-position // self.alignment) * self.alignment
+          buffer_offsets.append(position)
+          position += buffer.nbytes
+        record_length = -(-position // self.alignment) * self.alignment   # the next record starts aligned as well
+
+        offset = self.file_size
+        self.fh.seek(offset)
+        self.fh.write(struct.pack(self.header_format, self.magic, len(key_data), len(buffers), len(pickle_data), record_length, zlib.crc32(pickle_data, zlib.crc32(key_data))))
+        for buffer, buffer_offset in zip(buffers, buffer_offsets):
+          self.fh.write(struct.pack(self.buffer_format, buffer_offset, buffer.nbytes))
+        self.fh.write(key_data)
+        self.fh.write(pickle_data)
+        for buffer, buffer_offset in zip(buffers, buffer_offsets):
+          self.fh.write(bytes(buffer_offset - (self.fh.tell() - offset)))   # padding
+          self.fh.write(buffer)
+        self.fh.write(bytes(record_length - (self.fh.tell() - offset)))
+        self.fh.flush()
+
+        if key in self.index:
+          self.records_size -= self.index[key][1]
+        self.index[key] = (offset, record_length)
+        self.records_size += record_length
+        self.file_size = offset + record_length
+
+      #/ with Timer("file saving " + self.filename, self.quiet):
+
+      if self.file_size > max(self.compaction_min_size, 2 * self.records_size):
+        self.compact()
+
+  # / def put(self, key, value, pickled=False):
+
+  def compact(self):
+    """Rewrites the file with the latest records only. The records are copied without unpickling. The views returned by get before the compaction are invalid afterwards"""
+
+    if not self.release_mmaps() and os.name == 'nt':   # a mapped file cannot be replaced on Windows. The compaction is tried again on a later put
+      return
+
+    with open(self.fullfilename + ".tmp", "wb", 1024 * 1024) as fh:
+      for offset, record_length in self.index.values():
+        self.fh.seek(offset)
+        fh.write(self.fh.read(record_length))
+
+    self.fh.close()
+    rename_temp_file(self.fullfilename)
+
+    self.fh = open(self.fullfilename, "r+b")
+    self.scan()
+
+  # / def compact(self):
+
+  def close(self):
+    with self.lock:
+      self.release_mmaps()
+      self.fh.close()
+
+# / class PickleStore(object):
+
+
+class StringColumn(object):
+  """String column of a columnar log. Decodes the strings from the memory-mapped side table on access"""
+
+  def __init__(self, string_ids, string_offsets, string_data):
+    self.string_ids = string_ids
+    self.string_offsets = string_offsets
+    self.string_data = string_data
+
+  def __len__(self):
+    return len(self.string_ids)
+
+  def __getitem__(self, row_index):
+
+    string_id = int(self.string_ids[row_index])
+    if string_id < 0:
+      return None
+
+    start = int(self.string_offsets[string_id - 1]) if string_id > 0 else 0
+    end = int(self.string_offsets[string_id])
+    return bytes(self.string_data[start:end]).decode("utf-8")
+
+  def tolist(self):
+    return [self[row_index] for row_index in range(len(self))]
+
+# / class StringColumn(object):
+
+
+class ColumnarLog(object):
+  """Columnar binary log, written next to the TSV log. Each column is stored in its own file of raw little-endian values, so that the numeric columns can be memory-mapped with read_columnar_log without parsing.
+  The strings are stored once each in a side table (strings.bin with the end offsets in string_offsets.bin), and the string columns hold their indexes, -1 for None. schema.json lists the columns with their headers and types.
+  The column types are inferred from the values. When a later value does not fit, the column is widened: bool -> int64 -> float64 (None becomes NaN) -> string.
+  The rows are buffered and written into the columns in batches of batch_size rows, and on close. A flush appends the buffered rows to a journal file instead, so that a flush after every row costs one small write rather than a write to every column file. When the log is opened again, for example on resuming an interrupted run, the rows in the journal are buffered again. read_columnar_log does not return the rows which are still in the journal."""
+
+  dtypes = ["bool", "int64", "float64", "string"]   # from narrowest to widest
+  batch_size = 1000
+
+  def __init__(self, path, headers):
+
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+
+    self.headers = headers
+    self.header_keys = list(headers.keys())
+    self.journal_path = get_columnar_journal_path(path)
+    self.journal_file = None
+
+    self.schema_path = os.path.join(path, "schema.json")
+    if os.path.exists(self.schema_path):
+      with open(self.schema_path, "rt", encoding="utf-8") as fh:
+        self.column_dtypes = { column["key"]: column["dtype"] for column in json.load(fh)["columns"] }
+    else:
+      self.column_dtypes = {}
+
+    # the side table is appended to. On reopening, the index of the existing strings is rebuilt so that they are not stored twice
+    self.string_ids = {}
+    string_offsets, string_data = self.get_string_table()
+    start = 0
+    for string_id, end in enumerate(string_offsets.tolist()):
+      self.string_ids[bytes(string_data[start:end]).decode("utf-8")] = string_id
+      start = end
+    self.string_data_size = start
+    self.strings_file = open(os.path.join(path, "strings.bin"), "ab")
+    self.string_offsets_file = open(os.path.join(path, "string_offsets.bin"), "ab")
+
+    # a row may have been written partially when the process was interrupted
+    self.num_rows = get_num_columnar_log_column_rows(path)   # the rows written into the columns
+    self.pending_rows = read_columnar_journal(self.journal_path, self.num_rows)
+    self.num_journaled_rows = len(self.pending_rows)
+    self.truncate(self.num_rows + len(self.pending_rows))
+
+  @property
+  def num_logged_rows(self):
+    """The number of rows, including the rows not yet written into the columns"""
+    return self.num_rows + len(self.pending_rows)
+
+  def get_column_filename(self, key):
+    return os.path.join(self.path, key + ".bin")
+
+  def get_string_table(self):
+    return read_string_table(self.path)
+
+  def truncate(self, num_rows):
+
+    if self.journal_file is not None:
+      self.journal_file.close()
+      self.journal_file = None
+
+    truncate_columnar_log(self.path, num_rows)
+    num_pending_rows = max(0, num_rows - self.num_rows)
+    self.num_rows = min(self.num_rows, num_rows)
+    self.pending_rows = self.pending_rows[:num_pending_rows]
+    self.num_journaled_rows = min(self.num_journaled_rows, num_pending_rows)
+
+  def log_row(self, values):
+
+    self.pending_rows.append(values)
+    if len(self.pending_rows) >= self.batch_size:
+      self.write_batch()
+
+  def get_value_dtype(self, value):
+
+    import numpy as np   # NB! NumPy is imported only when needed, since most users of this module do not need it
+
+    if isinstance(value, str):
+      return "string"
+    elif isinstance(value, (bool, np.bool_)):
+      return "bool"
+    elif isinstance(value, (int, np.integer)):
+      return "int64"
+    elif value is None or isinstance(value, (float, np.floating)):
+      return "float64"
+    else:
+      return "string"   # other types are stored as their string representations
+
+  def add_string(self, text):
+
+    import numpy as np
+
+    string_id = self.string_ids.get(text)
+    if string_id is None:
+      data = text.encode("utf-8")
+      self.strings_file.write(data)
+      self.string_data_size += len(data)
+      self.string_offsets_file.write(np.array([self.string_data_size], dtype="<i8").tobytes())
+      string_id = len(self.string_ids)
+      self.string_ids[text] = string_id
+
+    return string_id
+
+  def to_column_array(self, values, dtype):
+
+    import numpy as np
+
+    if dtype == "string":
+      return np.array([-1 if value is None else self.add_string(str(value)) for value in values], dtype="<i8")
+    elif dtype == "float64":
+      return np.array([np.nan if value is None else value for value in values], dtype="<f8")
+    else:
+      return np.array(values, dtype=get_column_numpy_dtype(dtype))
+
+  def widen_column(self, key, dtype):
+    """Converts the already written values of the column to a wider type"""
+
+    import numpy as np
+
+    filename = self.get_column_filename(key)
+    old_dtype = self.column_dtypes[key]
+    values = np.fromfile(filename, dtype=get_column_numpy_dtype(old_dtype)) if os.path.exists(filename) else np.zeros(0)
+
+    if dtype == "string":
+      values = [None if old_dtype == "float64" and np.isnan(value) else value for value in values.tolist()]
+
+    self.strings_file.flush()
+    self.string_offsets_file.flush()
+
+    with open(filename + ".tmp", "wb") as fh:
+      fh.write(self.to_column_array(values, dtype).tobytes())
+    os.replace(filename + ".tmp", filename)
+
+    self.column_dtypes[key] = dtype
+
+  # / def widen_column(self, key, dtype):
+
+  def save_schema(self):
+
+    schema = {
+      "columns": [
+        { "key": key, "header": self.headers[key], "dtype": self.column_dtypes[key] }
+        for key in self.header_keys
+      ],
+    }
+    with open(self.schema_path + ".tmp", "wt", encoding="utf-8") as fh:
+      json.dump(schema, fh, indent=2)
+    os.replace(self.schema_path + ".tmp", self.schema_path)
+
+  def flush(self):
+    """Appends the buffered rows which are not in the journal yet to the journal"""
+
+    if self.num_journaled_rows == len(self.pending_rows):
+      return
+
+    if self.journal_file is None:
+      self.journal_file = open(self.journal_path, "ab")
+      if self.journal_file.tell() == 0:
+        write_columnar_journal_header(self.journal_file, self.num_rows)
+
+    write_columnar_journal_rows(self.journal_file, self.pending_rows[self.num_journaled_rows:])
+    self.journal_file.flush()
+    self.num_journaled_rows = len(self.pending_rows)
+
+  # / def flush(self):
+
+  def write_batch(self):
+    """Writes the buffered rows into the columns and empties the journal"""
+
+    if not self.pending_rows:
+      return
+
+    schema_changed = False
+    columns = list(zip(*self.pending_rows))
+    for key, values in zip(self.header_keys, columns):
+
+      dtype = max(
+        (self.get_value_dtype(value) for value in values if not (value is None and self.column_dtypes.get(key) == "string")),
+        key=self.dtypes.index,
+        default="string" if self.column_dtypes.get(key) == "string" else "float64"
+      )
+      old_dtype = self.column_dtypes.get(key)
+      if old_dtype is None:
+        self.column_dtypes[key] = dtype
+        schema_changed = True
+      elif self.dtypes.index(dtype) > self.dtypes.index(old_dtype):
+        self.widen_column(key, dtype)
+        schema_changed = True
+
+      with open(self.get_column_filename(key), "ab") as fh:
+        fh.write(self.to_column_array(values, self.column_dtypes[key]).tobytes())
+
+    #/ for key, values in zip(self.header_keys, columns):
+
+    self.strings_file.flush()
+    self.string_offsets_file.flush()
+
+    if schema_changed:
+      self.save_schema()
+
+    self.num_rows += len(self.pending_rows)
+    self.pending_rows = []
+
+    self.reset_journal()
+
+  # / def write_batch(self):
+
+  def reset_journal(self):
+    """Empties the journal, after its rows have been written into the columns"""
+
+    if self.journal_file is None:
+      if not os.path.exists(self.journal_path):
+        return
+      self.journal_file = open(self.journal_path, "ab")
+
+    self.journal_file.truncate(0)
+    write_columnar_journal_header(self.journal_file, self.num_rows)
+    self.journal_file.flush()
+    self.num_journaled_rows = 0
+
+  # / def reset_journal(self):
+
+  def close(self):
+
+    self.write_batch()
+    self.strings_file.close()
+    self.string_offsets_file.close()
+
+    if self.journal_file is not None:
+      self.journal_file.close()
+      self.journal_file = None
+    if os.path.exists(self.journal_path):
+      os.remove(self.journal_path)
+
+  # / def close(self):
+
+# / class ColumnarLog(object):
+
+
+def get_column_numpy_dtype(dtype):
+  """The string columns hold the int64 indexes of the strings in the side table"""
+  import numpy as np
+  return np.dtype({ "bool": "?", "int64": "<i8", "float64": "<f8", "string": "<i8" }[dtype])
+
+
+def get_columnar_journal_path(path):
+  return os.path.join(path, "pending_rows.journal")
+
+
+def write_columnar_journal_header(fh, first_row_no):
+  """The journal starts with the number of the row which its first entry belongs to, followed by the pickled rows with their lengths"""
+  fh.write(struct.pack("<Q", first_row_no))
+
+
+def write_columnar_journal_rows(fh, rows):
+  for values in rows:
+    data = pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+    fh.write(struct.pack("<I", len(data)) + data)
+
+
+def read_columnar_journal(journal_path, num_column_rows):
+  """Returns the rows in the journal of a columnar log which follow the num_column_rows rows already in the columns. A partially written last row is ignored"""
+
+  if not os.path.exists(journal_path):
+    return []
+
+  with open(journal_path, "rb") as fh:
+    data = fh.read()
+
+  if len(data) < 8:
+    return []
+  (first_row_no,) = struct.unpack_from("<Q", data, 0)
+
+  rows = []
+  offset = 8
+  while offset + 4 <= len(data):
+    (length,) = struct.unpack_from("<I", data, offset)
+    if offset + 4 + length > len(data):
+      break
+    rows.append(pickle.loads(data[offset + 4:offset + 4 + length]))
+    offset += 4 + length
+
+  # NB! when the process was interrupted after a batch was written into the columns but before the journal was emptied, the rows of the batch are in both
+  return rows[max(0, num_column_rows - first_row_no):]
+
+# / def read_columnar_journal(journal_path, num_column_rows):
+
+
+def get_num_columnar_log_column_rows(path):
+  """Returns the number of complete rows in the columns of a columnar log"""
+
+  schema_path = os.path.join(path, "schema.json")
+  if not os.path.exists(schema_path):
+    return 0
+
+  with open(schema_path, "rt", encoding="utf-8") as fh:
+    columns = json.load(fh)["columns"]
+
+  num_rows = None
+  for column in columns:
+    filename = os.path.join(path, column["key"] + ".bin")
+    column_rows = os.path.getsize(filename) // get_column_numpy_dtype(column["dtype"]).itemsize if os.path.exists(filename) else 0
+    num_rows = column_rows if num_rows is None else min(num_rows, column_rows)
+
+  return num_rows or 0
+
+# / def get_num_columnar_log_column_rows(path):
+
+
+def truncate_columnar_log(path, num_rows):
+  """Drops the rows after num_rows rows, both from the columns and from the journal. A partially written row is dropped as well. The strings used only by the dropped rows stay in the side table"""
+
+  schema_path = os.path.join(path, "schema.json")
+  num_old_column_rows = get_num_columnar_log_column_rows(path)
+  num_column_rows = min(num_rows, num_old_column_rows)
+
+  if os.path.exists(schema_path):
+
+    with open(schema_path, "rt", encoding="utf-8") as fh:
+      columns = json.load(fh)["columns"]
+
+    for column in columns:
+      filename = os.path.join(path, column["key"] + ".bin")
+      if os.path.exists(filename):
+        with open(filename, "r+b") as fh:
+          fh.truncate(num_column_rows * get_column_numpy_dtype(column["dtype"]).itemsize)
+
+  # the rows after the columns are in the journal
+  journal_path = get_columnar_journal_path(path)
+  if os.path.exists(journal_path):
+    rows = read_columnar_journal(journal_path, num_old_column_rows)
+    with open(journal_path + ".tmp", "wb") as fh:
+      write_columnar_journal_header(fh, num_column_rows)
+      write_columnar_journal_rows(fh, rows[:num_rows - num_column_rows])
+    os.replace(journal_path + ".tmp", journal_path)
+
+# / def truncate_columnar_log(path, num_rows):
+
+
+def read_string_table(path):
+  """Returns the memory-mapped end offsets and data of the strings of a columnar log"""
+
+  import numpy as np
+
+  def read_file_mmap(filename, dtype):
+    filename = os.path.join(path, filename)
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:   # empty files cannot be memory-mapped
+      return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r")
+
+  return read_file_mmap("string_offsets.bin", "<i8"), read_file_mmap("strings.bin", np.uint8)
+
+# / def read_string_table(path):
+
+
+def read_columnar_log(path):
+  """Loads a columnar log written by EventLog with columnar=True. Returns a dict of the columns by their keys. The numeric columns are memory-mapped arrays, the string columns are StringColumn objects. The headers are in schema.json"""
+
+  import numpy as np
+
+  with open(os.path.join(path, "schema.json"), "rt", encoding="utf-8") as fh:
+    schema = json.load(fh)
+
+  string_offsets, string_data = read_string_table(path)
+
+  arrays = {}
+  for column in schema["columns"]:
+    filename = os.path.join(path, column["key"] + ".bin")
+    dtype = get_column_numpy_dtype(column["dtype"])
+    if os.path.getsize(filename) == 0:
+      arrays[column["key"]] = np.zeros(0, dtype=dtype)
+    else:
+      arrays[column["key"]] = np.memmap(filename, dtype=dtype, mode="r")
+
+  num_rows = min((len(values) for values in arrays.values()), default=0)   # ignore a partially written last row
+
+  columns = {}
+  for column in schema["columns"]:
+    values = arrays[column["key"]][:num_rows]
+    columns[column["key"]] = StringColumn(values, string_offsets, string_data) if column["dtype"] == "string" else values
+
+  return columns
+
+# / def read_columnar_log(path):
+
+
+class RenderedText(str):
+  """Text rendered from a PromptTemplate. Behaves as the plain text, but remembers its template and parameter values, so that EventLog can store only these"""
+
+  def __new__(cls, text, template, parameter_values):
+    result = super(RenderedText, cls).__new__(cls, text)
+    result.template = template
+    result.parameter_values = parameter_values
+    return result
+
+  def __reduce__(self):   # keeps the template when the text is pickled in a checkpoint
+    return (RenderedText, (str(self), self.template, self.parameter_values))
+
+# / class RenderedText(str):
+
+
+class PromptTemplate(object):
+  """Prompt text with str.format style {name} placeholders. The hash identifies the template text in the logs"""
+
+  def __init__(self, text):
+
+    self.text = text
+    self.parameter_names = []
+    for _, name, _, _ in string.Formatter().parse(text):
+      if name is not None and name not in self.parameter_names:
+        self.parameter_names.append(name)
+
+    self.hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+  def render(self, **parameters):
+    return RenderedText(
+      self.text.format(**parameters),
+      self,
+      [parameters[name] for name in self.parameter_names]
+    )
+
+  def render_values(self, parameter_values):
+    return self.render(**dict(zip(self.parameter_names, parameter_values)))
+
+# / class PromptTemplate(object):
+
+
+template_reference_prefix = "$template:"
+
+
+def get_prompt_templates_path(record_path):
+  return os.path.splitext(str(record_path))[0] + ".templates.json"
+
+
+def load_prompt_templates(record_path):
+  """Returns the templates stored next to the log file, by their hashes"""
+
+  path = get_prompt_templates_path(record_path)
+  if not os.path.exists(path):
+    return {}
+
+  with open(path, "rt", encoding="utf-8") as fh:
+    return { template_hash: PromptTemplate(text) for template_hash, text in json.load(fh).items() }
+
+# / def load_prompt_templates(record_path):
+
+
+def render_logged_text(value, templates):
+  """Returns the full text of a value logged by EventLog with prompt_templates. Other values are returned unchanged"""
+
+  if not isinstance(value, str) or not value.startswith(template_reference_prefix):
+    return value
+
+  reference = value[len(template_reference_prefix):]
+  template_hash, separator, parameter_values = reference.partition(" ")
+  return str(templates[template_hash].render_values(json.loads(parameter_values)))
+
+# / def render_logged_text(value, templates):
+
+
+class BackgroundLogWriter(object):
+  """Background thread which performs the writes of all EventLogs in background mode, so that the disk I/O is not on the critical path of the trials.
+  The rows are taken from a bounded queue in batches and written, then each log with written rows is flushed at most once per batch (group commit), depending on its flush policy."""
+
+  max_batch_size = 1000
+  poll_interval = 1   # seconds, how often the waiting callers check that the writer thread is still alive
+
+  def __init__(self, max_queue_size=10000):
+
+    import queue
+    self.queue = queue.Queue(maxsize=max_queue_size)   # when the disk cannot keep up, the trials wait
+    self.error = None   # the exception which stopped the writer thread
+    self.thread = threading.Thread(target=self.run, name="event-log-writer", daemon=True)
+    self.thread.start()
+
+  def check_alive(self):
+    """Raises the error of the writer thread if the thread has stopped"""
+
+    if not self.thread.is_alive():
+      raise RuntimeError("The event log writer thread has stopped") from self.error
+
+  def put(self, log, command, payload=None):
+
+    import queue
+
+    while True:
+      self.check_alive()
+      try:
+        self.queue.put((log, command, payload), timeout=self.poll_interval)
+        return
+      except queue.Full:
+        pass
+
+  def wait(self, event, timeout=None):
+    """Waits until the writer thread sets the event. Raises the error of the writer thread if it stops meanwhile, and TimeoutError after timeout seconds"""
+
+    deadline = time.time() + timeout if timeout is not None else None
+    while not event.wait(self.poll_interval):
+      self.check_alive()
+      if deadline is not None and time.time() >= deadline:
+        raise TimeoutError("The event log writer thread did not respond in " + str(timeout) + " seconds")
+
+  def get_timeout(self, dirty_logs):
+    """Time until the next flush required by the flush_interval_ms policies, or None"""
+
+    deadlines = [
+      log.last_flush_time + log.flush_interval_ms / 1000
+      for log in dirty_logs
+      if log.flush_interval_ms is not None
+    ]
+    if not deadlines:
+      return None
+    return max(0, min(deadlines) - time.time())
+
+  def run(self):
+
+    try:
+      self.process_queue()
+    except BaseException as ex:   # the errors of the individual logs are stored by run_in_writer, this is for the errors of the writer itself
+      self.error = ex
+      raise
+
+  def process_queue(self):
+
+    import queue
+
+    dirty_logs = set()   # logs with written but not yet flushed rows
+
+    while True:
+
+      try:
+        items = [self.queue.get(timeout=self.get_timeout(dirty_logs))]
+      except queue.Empty:
+        items = []
+
+      while len(items) < self.max_batch_size:
+        try:
+          items.append(self.queue.get_nowait())
+        except queue.Empty:
+          break
+
+      logs_to_flush = set()
+      callbacks = []
+      closing_logs = []
+
+      for log, command, payload in items:
+        if command == "row":
+          log.run_in_writer(log.write_row, *payload)
+          dirty_logs.add(log)
+          log.num_unflushed_rows += 1
+          if log.flush_every_rows is not None and log.num_unflushed_rows >= log.flush_every_rows:
+            logs_to_flush.add(log)
+        elif command == "flush":
+          logs_to_flush.add(log)
+        elif command == "barrier":   # the callback runs after all earlier rows of the log are flushed
+          logs_to_flush.add(log)
+          callbacks.append((log, payload))
+        elif command == "close":
+          logs_to_flush.add(log)
+          closing_logs.append((log, payload))
+
+      now = time.time()
+      for log in dirty_logs:
+        if log.flush_interval_ms is not None and now >= log.last_flush_time + log.flush_interval_ms / 1000:
+          logs_to_flush.add(log)
+
+      for log in logs_to_flush:
+        log.run_in_writer(log.flush_files)
+        log.num_unflushed_rows = 0
+        log.last_flush_time = now
+        dirty_logs.discard(log)
+
+      for log, callback in callbacks:
+        log.run_in_writer(callback)
+
+      for log, closed_event in closing_logs:
+        log.run_in_writer(log.close_files)
+        closed_event.set()
+
+    #/ while True:
+
+  # / def process_queue(self):
+
+# / class BackgroundLogWriter(object):
+
+
+background_log_writer = None
+background_log_writer_lock = threading.Lock()
+
+def get_background_log_writer():
+  """The writer thread is shared by all logs and started on first use"""
+  global background_log_writer
+
+  with background_log_writer_lock:
+    if background_log_writer is None:
+      background_log_writer = BackgroundLogWriter()
+
+  return background_log_writer
+
+#/ def get_background_log_writer():
+
+
+open_event_logs = weakref.WeakSet()
+
+def close_open_event_logs():
+  """Closes the logs which were not closed because of an exception, so that the rows still in the buffers and in the background writer queue are not lost"""
+
+  for log in list(open_event_logs):
+    try:
+      log.close()
+    except Exception as ex:
+      safeprint("Error closing event log " + str(log.record_path) + ": " + str(ex))
+
+#/ def close_open_event_logs():
+
+atexit.register(close_open_event_logs)
+
+
 class EventLog(object):
+  """TSV log of the events. 
+  In background mode the rows are formatted in the calling thread, but written by the shared BackgroundLogWriter thread. Then the durability is set by the flush policy: the log is flushed after every flush_every_rows rows, when flush_interval_ms milliseconds have passed since the last flush, on an explicit flush() request, and on close. The calls to flush() do not wait, and the requests of consecutive rows are combined. An error of the writer thread is raised on the next call. If the writer thread stops, close() raises its error instead of waiting.
+  The log can be used as a context manager, and the logs not closed because of an exception are closed at exit."""
+
   default_gzip_compresslevel = 6  # 6 is default level for gzip: https://linux.die.net/man/1/gzip and https://github.com/ebiggers/libdeflate
+  close_timeout = 300   # seconds to wait for the background writer to write the remaining rows on close
 
   def __init__(
     self,
@@ -227,10 +1107,26 @@ class EventLog(object):
     headers,
     gzip_log=False,
     gzip_compresslevel=None,
+    columnar=False,
+    background=False,
+    flush_every_rows=None,
+    flush_interval_ms=None,
+    prompt_templates=False,
   ):
+    """With columnar, the events are additionally written in the columnar binary format of ColumnarLog, into a folder named after the TSV file with the .columns extension.
+    With prompt_templates, the texts rendered from a PromptTemplate are logged as a reference to the template together with the parameter values. Each template is stored once, in a file named after the TSV file with the .templates.json extension. Use render_logged_text in order to get the full texts back.
+    With gzip_log, the log is written into a compressed file with the additional .gz extension. Such a log cannot be truncated, so it has no offset for the checkpoints, and it cannot be combined with columnar."""
+
+    if gzip_log and columnar:
+      raise ValueError("gzip_log cannot be combined with columnar, since the columnar log is truncated to the rows of the TSV log on resume")
+
+    import csv
+    from pathlib import Path
+
     record_path = Path(os.path.join(experiment_dir, events_fname))
     # logger.info(f"Saving records to disk at {record_path}")
     record_path.parent.mkdir(exist_ok=True, parents=True)
+    self.record_path = record_path
 
     if isinstance(headers, dict):
       self.header_keys = list(headers.keys())  # used with log_event_from_dict
@@ -238,12 +1134,21 @@ class EventLog(object):
     else:
       self.header_keys = headers
 
+    if columnar:
+      self.columnar = ColumnarLog(get_columnar_log_path(record_path), dict(zip(self.header_keys, headers)))
+    else:
+      self.columnar = None
+
+    self.prompt_templates = load_prompt_templates(record_path) if prompt_templates else None
+
     if gzip_log:
       if gzip_compresslevel is None:
         gzip_compresslevel = self.default_gzip_compresslevel
-      write_header = not os.path.exists(record_path + ".gz")
+      gzip_path = str(record_path) + ".gz"
+      write_header = not os.path.exists(gzip_path)
+      import gzip
       self.file = gzip.open(
-        record_path + ".gz",
+        gzip_path,
         mode="at",
         newline="",
         encoding="utf-8",
@@ -259,28 +1164,61 @@ class EventLog(object):
         encoding="utf-8",
       )  # csv writer creates its own newlines therefore need to set newline to empty string here
 
-    self.writer = csv.writer(self.file, quoting=csv.QUOTE_MINIMAL, delimiter="\t")
+    # the rows are formatted into a buffer first, so that their sizes are known without waiting for the background writer
+    self.row_buffer = io.StringIO()
+    self.writer = csv.writer(self.row_buffer, quoting=csv.QUOTE_MINIMAL, delimiter="\t")
 
     if (
       write_header
     ):  # TODO: if the file already exists then assert that the header is same
-      self.writer.writerow(headers)
-      # self.file.flush()
+      self.file.write(self.format_row(headers))
+    self.file.flush()
+
+    self.size = None if gzip_log else os.path.getsize(record_path)   # the size of the log including the rows still queued
+    self.num_columnar_rows = self.columnar.num_logged_rows if self.columnar is not None else None
+
+    self.background = background
+    self.flush_every_rows = flush_every_rows
+    self.flush_interval_ms = flush_interval_ms
+    self.num_unflushed_rows = 0   # maintained by the writer thread
+    self.last_flush_time = time.time()
+    self.error = None
+    self.closed = False
+
+    open_event_logs.add(self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
+
+  def format_row(self, values):
+
+    self.row_buffer.seek(0)
+    self.row_buffer.truncate()
+    self.writer.writerow(values)
+    return self.row_buffer.getvalue()
 
   def log_event(self, event):
 
+    self.raise_writer_error()
+
     if isinstance(event, dict):
       values = [event.get(key) for key in self.header_keys]
     else:
       values = event
 
+    if self.prompt_templates is not None:
+      values = [self.get_template_reference(x) if isinstance(x, RenderedText) else x for x in values]
+
     # transformed_cols = []
     # for index, col in enumerate(event):
     #   # if type(col) == datetime.datetime:
     #   #  col = datetime.datetime.strftime(col, '%Y.%m.%d-%H.%M.%S')
     #   transformed_cols.append(col)
 
-    values = [
+    text_values = [
       x.strip().replace("\r", "\\r").replace("\n", "\\n").replace("\t", "\\t")   # CSV/TSV format does not support these characters
       # re.sub(r"[\n\r\t]", " ", x.strip())   # CSV/TSV format does not support these characters
       if isinstance(x, str) 
@@ -288,14 +1226,130 @@ class EventLog(object):
       for x in values
     ]
 
-    self.writer.writerow(values)
-    # self.file.flush()
+    text = self.format_row(text_values)
+    if self.size is not None:
+      self.size += len(text.encode("utf-8"))
+    if self.columnar is not None:
+      self.num_columnar_rows += 1
 
-  def flush(self):
+    if self.background:
+      get_background_log_writer().put(self, "row", (values, text))
+    else:
+      self.write_row(values, text)
+
+  # / def log_event(self, event):
+
+  def get_template_reference(self, text):
+    """Returns the compact representation of the rendered text, saving the template when it is used for the first time"""
+
+    template = text.template
+    if template.hash not in self.prompt_templates:
+      self.prompt_templates[template.hash] = template
+      path = get_prompt_templates_path(self.record_path)
+      with open(path + ".tmp", "wt", encoding="utf-8") as fh:
+        json.dump({ template_hash: template.text for template_hash, template in self.prompt_templates.items() }, fh, indent=2)
+      os.replace(path + ".tmp", path)
+
+    return template_reference_prefix + template.hash + " " + json.dumps(text.parameter_values, separators=(",", ":"))
+
+  # / def get_template_reference(self, text):
+
+  def write_row(self, values, text):
+
+    self.file.write(text)
+    if self.columnar is not None:
+      self.columnar.log_row(values)   # the binary format stores the strings as they are
+
+  def flush_files(self):
     self.file.flush()
+    if self.columnar is not None:
+      self.columnar.flush()
 
-  def close(self):
+  def close_files(self):
     self.file.flush()
     self.file.close()
+    if self.columnar is not None:
+      self.columnar.close()
+
+  def run_in_writer(self, function, *args):
+    """Runs a write operation in the background writer thread, storing the error for raising it in the calling thread"""
+
+    try:
+      function(*args)
+    except Exception as ex:
+      if self.error is None:
+        self.error = ex
+
+  def raise_writer_error(self):
+
+    if self.error is not None:
+      error = self.error
+      self.error = None
+      raise error
+
+  def flush(self):
+
+    self.raise_writer_error()
+    if self.background:
+      get_background_log_writer().put(self, "flush")
+    else:
+      self.flush_files()
+
+  def call_after_flush(self, callback):
+    """Calls the callback once all rows logged so far have been flushed. In background mode the callback runs later in the writer thread, so it must not depend on state which the caller modifies meanwhile"""
+
+    self.raise_writer_error()
+    if self.background:
+      get_background_log_writer().put(self, "barrier", callback)
+    else:
+      self.flush_files()
+      callback()
+
+  def get_offset(self):
+    """Returns the current end of the log, including the rows still queued, for truncate_event_log. That is the size of the uncompressed TSV file in bytes and the number of rows of the columnar log"""
+
+    if self.size is None:   # NB! a gzip file cannot be truncated at a row boundary, since the compressed stream of the later rows depends on the earlier ones
+      raise ValueError("The offset of a gzip compressed log is not available. Use an uncompressed log with checkpoints")
+
+    return {
+      "size": self.size,
+      "num_rows": self.num_columnar_rows,
+    }
+
+  def close(self):
+
+    if self.closed:
+      return
+    self.closed = True
+    open_event_logs.discard(self)
+
+    if self.background:
+      closed_event = threading.Event()
+      writer = get_background_log_writer()
+      writer.put(self, "close", closed_event)
+      writer.wait(closed_event, self.close_timeout)
+    else:
+      self.close_files()
+
+    self.raise_writer_error()
+
+  # / def close(self):
 
 # / class EventLog(object):
+
+
+def get_columnar_log_path(record_path):
+  return os.path.splitext(str(record_path))[0] + ".columns"
+
+
+def truncate_event_log(experiment_dir, events_fname, offset):
+  """Drops the events logged after the given offset of EventLog.get_offset, for example the rows written after the last checkpoint"""
+
+  record_path = os.path.join(experiment_dir, events_fname)
+  with open(record_path, "r+b") as fh:
+    fh.truncate(offset["size"])
+
+  if offset["num_rows"] is not None:
+    truncate_columnar_log(get_columnar_log_path(record_path), offset["num_rows"])
+
+# / def truncate_event_log(experiment_dir, events_fname, offset):
@@ -0,0 +1,34 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import sys
+
+import pytest
+
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_dir)   # the modules of the repository are imported by their names
+
+
+# NB! the modules read config.ini from the current folder once, so all tests use the same config. The scripted model needs no network access
+test_config = """
+[Model params]
+name = "scripted/random:5"
+
+[Tokenizer params]
+download = False
+"""
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+  """Runs the test in an empty folder with the test config.ini and a data folder"""
+
+  (tmp_path / "config.ini").write_text(test_config, encoding="utf-8")
+  (tmp_path / "data").mkdir()
+  monkeypatch.chdir(tmp_path)
+  return tmp_path
@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+from LLMUtilities import ActionParser
+
+
+def test_parse_single_value():
+
+  action_parser = ActionParser()
+
+  assert action_parser.parse("5") == [5]
+  assert action_parser.parse(" I consume 7 potatoes.\n") == [7]
+  assert action_parser.parse("-3") == [-3]
+
+
+def test_parse_rejects_wrong_number_of_values():
+
+  action_parser = ActionParser()
+
+  assert action_parser.parse("5 or 10") is None
+  assert action_parser.parse("none") is None
+  assert action_parser.parse("") is None
+
+
+def test_parse_multiple_values():
+
+  action_parser = ActionParser(3)
+
+  assert action_parser.parse("1, 2, 3") == [1, 2, 3]
+  assert action_parser.parse("1, 2") is None
+  assert action_parser.parse("1, 2, 3, 4") is None
+
+
+def test_parse_structured_output():
+
+  action_parser = ActionParser(2, ["A", "B"])
+
+  assert action_parser.parse('{"A": 1, "B": 2}') == [1, 2]
+  assert action_parser.parse('{"A": 1}') is None
+  assert action_parser.parse('{"A": 1, "B": "2"}') is None
+  assert action_parser.parse('{"A": 1, "B": true}') is None
+  assert action_parser.parse('{"A": 1, ') is None
+
+
+def test_is_complete():
+
+  action_parser = ActionParser()
+
+  assert not action_parser.is_complete("5")   # more digits may follow
+  assert not action_parser.is_complete("Step 3: I consume 5")
+  assert action_parser.is_complete("5\n")
+  assert action_parser.is_complete("5, 6 ")   # too many values, would be rejected anyway
+  assert not action_parser.is_complete('{"amount": 5')
+  assert action_parser.is_complete('{"amount": 5}')
@@ -0,0 +1,147 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+import sys
+import glob
+import subprocess
+
+import pytest
+
+import BenchmarkRunner
+import Homeostasis
+import Sustainability
+import MultiObjectiveHomeostasisParallel
+
+from conftest import (
+  repository_dir,
+  test_config,
+)
+
+
+model_name = "scripted/random:5"
+
+benchmarks = {
+  "Homeostasis": Homeostasis.homeostasis_benchmark,
+  "Sustainability": Sustainability.sustainability_benchmark,
+  "MultiObjectiveHomeostasisParallel": MultiObjectiveHomeostasisParallel.multiobjective_homeostasis_with_parallel_actions_benchmark,
+}
+
+
+def read_logs(experiment_dir):
+  """Returns the sorted rows of all logs in the folder, without the columns which depend on the timing"""
+
+  rows = []
+  for path in glob.glob(os.path.join(experiment_dir, "data", "*.tsv")):
+    with open(path, "rt", encoding="utf-8") as fh:
+      lines = fh.read().splitlines()
+
+    headers = lines[0].split("\t")
+    timing_column_index = headers.index("Output tokens per second")
+    for line in lines[1:]:
+      rows.append("\t".join(value for index, value in enumerate(line.split("\t")) if index != timing_column_index))
+
+  return sorted(rows)
+
+# / def read_logs(experiment_dir):
+
+
+@pytest.fixture
+def settings(monkeypatch):
+  monkeypatch.setattr(BenchmarkRunner, "num_trials", 3)
+  monkeypatch.setattr(BenchmarkRunner, "simulation_length_steps", 20)
+  monkeypatch.setattr(BenchmarkRunner, "num_candidates", 2)
+
+
+def run_benchmark(experiment_dir, benchmark_name, max_parallel_trials, lockstep, monkeypatch):
+
+  experiment_dir.mkdir()
+  (experiment_dir / "config.ini").write_text(test_config, encoding="utf-8")
+  monkeypatch.chdir(experiment_dir)
+  monkeypatch.setattr(BenchmarkRunner, "max_parallel_trials", max_parallel_trials)
+  monkeypatch.setattr(BenchmarkRunner, "lockstep_scheduling", lockstep)
+
+  benchmarks[benchmark_name]([model_name])
+
+  return read_logs(experiment_dir)
+
+# / def run_benchmark(experiment_dir, benchmark_name, max_parallel_trials, lockstep, monkeypatch):
+
+
+@pytest.mark.parametrize("benchmark_name", benchmarks.keys())
+def test_scheduling_modes_give_identical_results(benchmark_name, tmp_path, settings, monkeypatch):
+
+  sequential_rows = run_benchmark(tmp_path / "sequential", benchmark_name, 1, False, monkeypatch)
+  threaded_rows = run_benchmark(tmp_path / "threaded", benchmark_name, 3, False, monkeypatch)
+  lockstep_rows = run_benchmark(tmp_path / "lockstep", benchmark_name, 3, True, monkeypatch)
+
+  assert len(sequential_rows) > 0
+  assert threaded_rows == sequential_rows
+  assert lockstep_rows == sequential_rows
+
+# / def test_scheduling_modes_give_identical_results(benchmark_name, tmp_path, settings, monkeypatch):
+
+
+# runs a benchmark in a separate process, which exits abruptly after the given number of LLM requests when that is not 0, as when the run is killed
+interrupted_run_script = """
+import os
+import sys
+
+import BenchmarkRunner
+import TrialScheduler
+
+benchmark_name, exit_after_requests = sys.argv[1], int(sys.argv[2])
+sys.argv = sys.argv[:1] + sys.argv[3:]   # the rest is for parse_command_line_args
+
+BenchmarkRunner.num_trials = 3
+BenchmarkRunner.simulation_length_steps = 20
+BenchmarkRunner.max_parallel_trials = 1
+BenchmarkRunner.num_candidates = 2
+
+run_llm_completion = TrialScheduler.run_llm_completion
+num_requests = 0
+
+def run_llm_completion_until_exit(**kwargs):
+  global num_requests
+  num_requests += 1
+  if num_requests == exit_after_requests:
+    os._exit(3)
+  return run_llm_completion(**kwargs)
+
+TrialScheduler.run_llm_completion = run_llm_completion_until_exit
+
+__import__(benchmark_name).main()
+"""
+
+
+def run_benchmark_process(experiment_dir, benchmark_name, exit_after_requests, *args):
+
+  return subprocess.run(
+    [sys.executable, "-c", interrupted_run_script, benchmark_name, str(exit_after_requests), *args],
+    cwd=experiment_dir,
+    env=dict(os.environ, PYTHONPATH=repository_dir),
+    stdout=subprocess.DEVNULL,
+  ).returncode
+
+# / def run_benchmark_process(experiment_dir, benchmark_name, exit_after_requests, *args):
+
+
+@pytest.mark.parametrize("benchmark_name", benchmarks.keys())
+def test_resumed_run_gives_same_log_as_uninterrupted_run(benchmark_name, tmp_path):
+
+  for experiment_dir in [tmp_path / "interrupted", tmp_path / "uninterrupted"]:
+    experiment_dir.mkdir()
+    (experiment_dir / "config.ini").write_text(test_config, encoding="utf-8")
+
+  assert run_benchmark_process(tmp_path / "interrupted", benchmark_name, 30) == 3   # in the middle of the second trial
+  assert run_benchmark_process(tmp_path / "interrupted", benchmark_name, 0, "--resume") == 0
+  assert run_benchmark_process(tmp_path / "uninterrupted", benchmark_name, 0) == 0
+
+  uninterrupted_rows = read_logs(tmp_path / "uninterrupted")
+  assert len(uninterrupted_rows) > 0
+  assert read_logs(tmp_path / "interrupted") == uninterrupted_rows
+
+# / def test_resumed_run_gives_same_log_as_uninterrupted_run(benchmark_name, tmp_path):
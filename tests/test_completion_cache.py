@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import time
+
+from CompletionCache import CompletionCache
+
+
+def get_entry_size(key, value_text):
+  return len(key) + len(value_text.encode("utf-8"))
+
+
+def test_get_and_put(tmp_path):
+
+  cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+
+  assert cache.get("a") is None
+  cache.put("a", {"content": "5"})
+  assert cache.get("a") == {"content": "5"}
+
+  cache.close()
+
+
+def test_make_key():
+
+  messages = [{"role": "user", "content": "How many?"}]
+  key = CompletionCache.make_key("model", messages, 0, 100, 0)
+
+  assert key == CompletionCache.make_key("model", list(messages), 0, 100, 0)
+  assert key != CompletionCache.make_key("model", messages, 0, 100, 1)   # another sample
+  assert key != CompletionCache.make_key("model", messages, 0, 100, 0, {"n": 2})
+
+
+def test_size_accounting_on_replace(tmp_path):
+
+  cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+
+  for length in [10, 1000, 3]:
+    cache.put("a", {"content": "x" * length})
+  cache.put("b", {"content": "y"})
+
+  assert cache.size_bytes == cache.get_size_bytes()
+  assert cache.size_bytes == get_entry_size("a", '{"content": "xxx"}') + get_entry_size("b", '{"content": "y"}')
+
+  cache.close()
+
+  cache = CompletionCache(str(tmp_path / "cache.sqlite"))   # the size is also counted on opening
+  assert cache.size_bytes == get_entry_size("a", '{"content": "xxx"}') + get_entry_size("b", '{"content": "y"}')
+  cache.close()
+
+# / def test_size_accounting_on_replace(tmp_path):
+
+
+def test_eviction_of_least_recently_used(tmp_path):
+
+  entry_size = get_entry_size("key0", '{"content": "' + "x" * 100 + '"}')
+  cache = CompletionCache(str(tmp_path / "cache.sqlite"), max_size_bytes=10 * entry_size)
+
+  for index in range(10):
+    cache.put("key" + str(index), {"content": "x" * 100})
+    time.sleep(0.001)   # distinct access times
+
+  assert cache.get("key0") is not None   # key0 becomes the most recently used entry
+  time.sleep(0.001)
+
+  cache.put("key10", {"content": "x" * 100})   # exceeds the limit
+
+  assert cache.size_bytes == cache.get_size_bytes()
+  assert cache.size_bytes <= cache.max_size_bytes * cache.eviction_target_ratio
+  assert cache.get("key0") is not None
+  assert cache.get("key10") is not None
+  assert cache.get("key1") is None   # the least recently used entries are evicted
+  assert cache.get("key2") is None
+
+  cache.close()
+
+# / def test_eviction_of_least_recently_used(tmp_path):
+
+
+def test_access_times_are_written_in_batches(tmp_path):
+
+  cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+  cache.put("a", {"content": "5"})
+
+  cache.get("a")
+  assert "a" in cache.pending_access_times
+
+  for _ in range(cache.access_flush_every - 1):   # together with the hit above
+    cache.get("a")
+  assert not cache.pending_access_times   # written to the database
+
+  cache.get("a")
+  access_time = cache.pending_access_times["a"]
+  cache.close()   # the pending access times are written on close
+
+  cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+  assert cache.connection.execute("SELECT last_access FROM completions WHERE key = 'a'").fetchone()[0] == access_time
+  cache.close()
+
+# / def test_access_times_are_written_in_batches(tmp_path):
@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import pytest
+
+from LLMUtilities import (
+  ContextWindowPolicy,
+  MessageHistory,
+  num_tokens_from_messages,
+)
+
+
+model_name = "scripted/constant:1"   # counted with the approximate encoding
+
+
+def get_messages(num_steps):
+
+  messages = [{"role": "system", "content": "system prompt"}]
+  for step in range(1, num_steps + 1):
+    messages.append({"role": "user", "content": f"observation {step}"})
+    messages.append({"role": "assistant", "content": str(step)})
+  messages.append({"role": "user", "content": "latest observation"})
+  return messages
+
+# / def get_messages(num_steps):
+
+
+def test_default_trim_ratio():
+  assert ContextWindowPolicy().trim_ratio == ContextWindowPolicy.default_trim_ratio == 0.75
+
+
+def test_trim_by_steps():
+
+  policy = ContextWindowPolicy(max_steps=8)
+
+  messages = get_messages(7)
+  assert policy.trim(messages) == 0   # within the limit
+  assert len(messages) == 16
+
+  messages = get_messages(8)   # 9 steps together with the latest observation
+  assert policy.trim(messages) == 3   # down to 0.75 of the limit
+  assert messages[0]["content"] == "system prompt"   # the pinned message is kept
+  assert messages[1]["content"] == "observation 4"   # the oldest pairs are dropped
+  assert messages[-1]["content"] == "latest observation"
+
+
+def test_trim_by_tokens(workdir):
+
+  messages = MessageHistory(model_name, get_messages(20))
+  max_tokens = messages.num_tokens - 1
+  policy = ContextWindowPolicy(max_tokens=max_tokens, model_name=model_name)
+
+  num_dropped = policy.trim(messages)
+
+  assert num_dropped > 0
+  assert messages.num_tokens <= max_tokens * policy.trim_ratio
+  assert messages.num_tokens == num_tokens_from_messages(list(messages), model_name)   # the running count stays exact
+  assert messages[0]["content"] == "system prompt"
+  assert messages[-1]["content"] == "latest observation"
+
+
+def test_trim_plain_list_as_message_history(workdir):
+
+  policy = ContextWindowPolicy(max_tokens=60, model_name=model_name)
+
+  messages = get_messages(20)
+  history = MessageHistory(model_name, messages)
+
+  assert policy.trim(messages) == policy.trim(history)
+  assert list(messages) == list(history)
+
+
+def test_trim_plain_list_needs_model_name():
+
+  policy = ContextWindowPolicy(max_tokens=60)
+  with pytest.raises(ValueError):
+    policy.trim(get_messages(20))
+
+
+def test_latest_observation_is_never_dropped(workdir):
+
+  messages = MessageHistory(model_name, get_messages(3))
+  policy = ContextWindowPolicy(max_tokens=1, model_name=model_name)   # nothing fits
+
+  policy.trim(messages)
+
+  assert [message["content"] for message in messages] == ["system prompt", "latest observation"]
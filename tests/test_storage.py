@@ -0,0 +1,174 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Repository: https://github.com/levitation-opensource/bioblue
+
+import os
+
+import numpy as np
+
+from Utilities import (
+  PickleStore,
+  ColumnarLog,
+  EventLog,
+  read_columnar_log,
+  truncate_event_log,
+)
+
+
+def test_pickle_store_round_trip(workdir):
+
+  store = PickleStore("store.pkls")
+  store.put("a", {"x": 1})
+  store.put(("b", 2), [1, 2, 3])
+  store.put("a", {"x": 2})   # supersedes the earlier record
+  store.close()
+
+  store = PickleStore("store.pkls")
+  assert sorted(store.keys(), key=str) == sorted(["a", ("b", 2)], key=str)
+  assert store.get("a") == {"x": 2}
+  assert store.get(("b", 2)) == [1, 2, 3]
+  assert store.get("c", "default") == "default"
+  store.close()
+
+# / def test_pickle_store_round_trip(workdir):
+
+
+def test_pickle_store_arrays(workdir):
+
+  array = np.arange(100000, dtype=np.int64)
+
+  store = PickleStore("store.pkls")
+  store.put("array", array)
+
+  view = store.get("array")   # memory-mapped without copying
+  assert np.array_equal(view, array)
+  assert not view.flags.writeable
+
+  copy = store.get("array", zero_copy=False)
+  assert np.array_equal(copy, array)
+  assert copy.flags.writeable
+
+  del view
+  store.close()
+
+# / def test_pickle_store_arrays(workdir):
+
+
+def test_pickle_store_ignores_incomplete_last_record(workdir):
+
+  store = PickleStore("store.pkls")
+  store.put("a", 1)
+  store.put("b", 2)
+  store.close()
+
+  path = os.path.join("data", "store.pkls")
+  with open(path, "r+b") as fh:   # an interrupted write
+    fh.truncate(os.path.getsize(path) - 1)
+
+  store = PickleStore("store.pkls")
+  assert store.get("a") == 1
+  assert "b" not in store
+
+  store.put("c", 3)   # overwrites the incomplete record
+  store.close()
+
+  store = PickleStore("store.pkls")
+  assert store.get("a") == 1
+  assert store.get("c") == 3
+  store.close()
+
+# / def test_pickle_store_ignores_incomplete_last_record(workdir):
+
+
+headers = {
+  "step_no": "Step number",
+  "value": "Value",
+  "text": "Text",
+}
+
+
+def get_rows(num_rows):
+  return [[step, step * 2, "row " + str(step)] for step in range(num_rows)]
+
+
+def test_columnar_log_round_trip(tmp_path):
+
+  path = str(tmp_path / "log.columns")
+  rows = get_rows(2500)   # more than one batch
+
+  log = ColumnarLog(path, headers)
+  for row in rows:
+    log.log_row(row)
+  log.close()
+
+  columns = read_columnar_log(path)
+  assert columns["step_no"].tolist() == [row[0] for row in rows]
+  assert columns["value"].dtype == np.int64
+  assert columns["text"].tolist() == [row[2] for row in rows]
+
+# / def test_columnar_log_round_trip(tmp_path):
+
+
+def test_columnar_log_widening(tmp_path):
+
+  path = str(tmp_path / "log.columns")
+
+  log = ColumnarLog(path, headers)
+  log.log_row([1, True, "a"])
+  log.log_row([2, 3, "b"])   # bool -> int64
+  log.log_row([3, None, "c"])   # int64 -> float64
+  log.log_row([4, "text", None])   # float64 -> string
+  log.close()
+
+  columns = read_columnar_log(path)
+  assert columns["step_no"].tolist() == [1, 2, 3, 4]
+  assert columns["value"].tolist() == ["True", "3", None, "text"]
+  assert columns["text"].tolist() == ["a", "b", "c", None]
+
+# / def test_columnar_log_widening(tmp_path):
+
+
+def test_columnar_log_journal_recovery(tmp_path):
+
+  path = str(tmp_path / "log.columns")
+  rows = get_rows(1500)
+
+  log = ColumnarLog(path, headers)
+  for row in rows:
+    log.log_row(row)
+  log.flush()   # the rows after the first batch go to the journal
+  # the log is not closed, as after an interruption
+
+  log = ColumnarLog(path, headers)   # the journaled rows are buffered again
+  assert log.num_logged_rows == len(rows)
+  log.log_row([1500, 3000, "row 1500"])
+  log.close()
+
+  columns = read_columnar_log(path)
+  assert columns["step_no"].tolist() == list(range(1501))
+  assert columns["text"].tolist()[-1] == "row 1500"
+
+# / def test_columnar_log_journal_recovery(tmp_path):
+
+
+def test_event_log_truncation(tmp_path):
+
+  log = EventLog(str(tmp_path), "log.tsv", headers, columnar=True)
+  for row in get_rows(10):
+    log.log_event(dict(zip(headers.keys(), row)))
+    if row[0] == 5:
+      offset = log.get_offset()   # the end of the log before the row of step 6
+  log.close()
+
+  truncate_event_log(str(tmp_path), "log.tsv", offset)
+
+  with open(tmp_path / "log.tsv", "rt", encoding="utf-8") as fh:
+    lines = fh.read().splitlines()
+  assert len(lines) == 1 + 6   # the header and steps 0 to 5
+
+  columns = read_columnar_log(str(tmp_path / "log.columns"))
+  assert columns["step_no"].tolist() == list(range(6))
+
+# / def test_event_log_truncation(tmp_path):